@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark each stage of the processing on synthetic recordings (see synth_ndi).
+
+    python bench_ema.py                       # 10, 60 and 300 s recordings
+    python bench_ema.py --sizes 60 600 --json run.jsonl
+    python bench_ema.py --json new.jsonl --compare run.jsonl
+
+For every recording size, each stage is timed and its peak memory (numpy and python
+allocations, by tracemalloc, in a second run) measured; throughput is reported in
+frames per second.  With --json the results are written one stage per line, and --compare prints the ratio
+of each stage's time to the same stage and size in an earlier run.
+"""
+import os, sys, json, time, shutil, tempfile, tracemalloc, argparse
+import numpy as np
+import pandas as pd
+import ema, synth_ndi
+
+def measure(func, setup=None):
+    '''
+    run func(), returning its result, the wall time (s) and the peak memory (bytes).
+    tracemalloc slows down python code a lot, so the time and the memory come from
+    separate runs.  If there is a setup, it is called (untimed) before each run and
+    func is called with what it returns, e.g. a fresh copy of data that func modifies.
+    '''
+    args = () if setup is None else (setup(),)
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+
+    args = () if setup is None else (setup(),)
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+def bench_recording(mydir, duration, channels=16, fs=200, dropout=0.01):
+    '''
+    write a synthetic recording of duration seconds and time each stage on it
+
+    Output
+        a list of dicts: stage, duration, frames, seconds, frames_per_s, peak_mb
+    '''
+    fname = 'bench_{:g}s.tsv'.format(duration)
+    sensors = synth_ndi.write_recording(os.path.join(mydir, fname), channels, duration, fs, dropout)
+    subcolumns = synth_ndi.subcolumns
+    nframes = int(round(duration * fs))
+    cal = {}
+    data = {}
+
+    def calibrate():
+        ema._calibrations.clear()
+        calname = os.path.join(mydir, os.path.splitext(fname)[0] + '.cal')
+        if os.path.exists(calname):
+            os.remove(calname)
+        cal['cal'] = ema.biteplate_calibration(mydir, fname, sensors, subcolumns)
+
+    def unmasked():
+        usecols, kwargs = ema._read_csv_args(os.path.join(mydir, fname), sensors, subcolumns, None, None)
+        return pd.read_csv(os.path.join(mydir, fname), **kwargs)
+
+    raw = unmasked()
+    # (stage, setup, func): the stages that modify their input get a copy of it from
+    # setup, made outside of the timing
+    stages = [
+        ('parse', None, lambda: ema.read_ndi_data(mydir, fname, sensors, subcolumns, cache=False)),
+        ('parse_xyz', None, lambda: ema.read_ndi_data(mydir, fname, sensors, subcolumns, cache=False,
+                                                      fields=['state', 'x', 'y', 'z'])),
+        ('parse_float32', None, lambda: ema.read_ndi_data(mydir, fname, sensors, subcolumns,
+                                                          cache=False, dtype=np.float32)),
+        ('parse_cached', None, lambda: ema.read_ndi_data(mydir, fname, sensors, subcolumns)),
+        ('mask', raw.copy, lambda df: ema.mask_bad_states(df, sensors, subcolumns)),
+        ('calibration', None, calibrate),
+        ('head_correction', lambda: data['df'].copy(), lambda df: data.update(
+            head=ema.head_correct_data(df, cal['cal'].ideal_head, sensors))),
+        ('referenced_rotation', lambda: data['df'].copy(), lambda df: ema.rotate_referenced_data(
+            df, cal['cal'].m, cal['cal'].origin, sensors)),
+        ('save_ndi', None, lambda: ema.save_rotated(mydir, fname, data['head'])),
+        ('save_binary', None, lambda: ema.save_rotated_binary(mydir, fname, data['head'], sensors, fs)),
+    ]
+
+    results = []
+    for stage, setup, func in stages:
+        if stage == 'parse_cached':   # make sure there is something in the cache
+            ema.read_ndi_data(mydir, fname, sensors, subcolumns)
+        result, elapsed, peak = measure(func, setup)
+        if stage == 'parse':
+            data['df'] = result
+        results.append({'stage': stage, 'duration': duration, 'frames': nframes,
+                        'seconds': elapsed, 'frames_per_s': nframes / elapsed,
+                        'peak_mb': peak / 1e6})
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the EMA processing stages.')
+    parser.add_argument('--sizes', nargs='+', type=float, default=[10, 60, 300],
+                        help='recording durations (s)')
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--dropout', type=float, default=0.01)
+    parser.add_argument('--json', help='write the results to this file, one json object per line')
+    parser.add_argument('--compare', help='a --json file from an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='bench_ema_')
+    saved_cache = ema.cache_dir
+    ema.cache_dir = os.path.join(tmp, 'cache')   # don't fill up, or use, the user's cache
+    try:
+        results = []
+        for duration in args.sizes:
+            results += bench_recording(tmp, duration, args.channels, dropout=args.dropout)
+    finally:
+        ema.cache_dir = saved_cache
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    before = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            before = {(r['stage'], r['duration']): r for r in map(json.loads, f)}
+
+    print('{:<20} {:>8} {:>8} {:>10} {:>12} {:>9}{}'.format(
+        'stage', 'dur (s)', 'frames', 'time (s)', 'frames/s', 'peak MB', '  vs before' if before else ''))
+    for r in results:
+        line = '{stage:<20} {duration:>8g} {frames:>8} {seconds:>10.4f} {frames_per_s:>12.0f} {peak_mb:>9.1f}'.format(**r)
+        old = before.get((r['stage'], r['duration']))
+        if old:
+            line += '  {:>8.2f}x'.format(r['seconds'] / old['seconds'])
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
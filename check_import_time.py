@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the headless modules import quickly, and without the GUI or pandas.
+
+    python check_import_time.py                    # ema, ema_batch, ema_audio; 250 ms budget
+    python check_import_time.py --budget 150 --repeat 9 ema
+
+Each module is imported in a fresh interpreter (as a batch worker would), --repeat
+times, and the fastest import is compared with the budget (ms).  The modules that must
+not be imported along the way (--forbid, by default Qt, matplotlib and pandas) are
+checked too.  The exit status is 1 if any module is over budget or imports a
+forbidden module, so this can be run before a batch is queued or in a build.
+"""
+import sys, json, subprocess, argparse
+
+headless = ['ema', 'ema_batch', 'ema_audio']
+forbidden = ['PyQt5', 'matplotlib', 'pandas']
+
+# run in the child: time the import, and list the forbidden modules that came with it
+child = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds,
+                  'loaded': [m for m in {forbid!r} if m in sys.modules]}}))
+'''
+
+def time_import(module, forbid=forbidden, repeat=5):
+    '''
+    import module in repeat fresh interpreters
+
+    Output
+        seconds - the fastest import time
+        loaded - the forbidden modules that were imported with it
+    '''
+    best, loaded = None, []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', child.format(module=module, forbid=forbid)],
+                             capture_output=True, text=True, check=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        best = r['seconds'] if best is None else min(best, r['seconds'])
+        loaded = r['loaded']
+    return best, loaded
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the import time of the headless modules.')
+    parser.add_argument('modules', nargs='*', default=headless)
+    parser.add_argument('--budget', type=float, default=250., help='import time budget (ms)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--forbid', nargs='*', default=forbidden,
+                        help='modules that must not be imported')
+    args = parser.parse_args(argv)
+
+    ok = True
+    print('{:<16} {:>10} {:>10}  {}'.format('module', 'ms', 'budget', 'forbidden imports'))
+    for module in args.modules:
+        seconds, loaded = time_import(module, args.forbid, args.repeat)
+        over = seconds * 1000 > args.budget
+        ok = ok and not over and not loaded
+        print('{:<16} {:>10.1f} {:>10g}  {}{}'.format(module, seconds * 1000, args.budget,
+              ' '.join(loaded) or '-', '  OVER BUDGET' if over else ''))
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,26 +8,45 @@ Created on Sat Oct 14 21:19:42 2017
 import numpy as np
 from numpy import cross,dot
 from numpy.linalg import norm
-import pandas as pd
-import os
+import os, json, hashlib, shutil
+# pandas takes longer to import than all the rest; it is imported by the functions
+# that make DataFrames, so the geometry can be used without it
+from ema_instrument import instrumented
 
-def read_ndi_data(mydir, file_name,sensors,subcolumns):
+# Parsed recordings are cached as binary arrays, so that reading the same .tsv again is
+# close to the cost of a memory map.  Set cache_dir to None to turn caching off.
+cache_dir = os.environ.get('EMA_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'ema_head_correction'))
+cache_max_bytes = 2 * 1024**3   # least recently used entries are removed beyond this
+CACHE_VERSION = 3               # bump when the parsed representation changes
+
+def _frame_counts(df, nbytes=None):
+    '''rows, nan values and dropouts of a dataframe, for the stage log (see ema_instrument)'''
+    counts = {'file': df.attrs.get('source'), 'rows': len(df),
+              'nan': int(np.isnan(df.select_dtypes('floating').to_numpy()).sum())}
+    if nbytes is not None:
+        counts['bytes'] = nbytes
+    if 'dropouts' in df.attrs:
+        counts['dropouts'] = df.attrs['dropouts']
+    return counts
+
+def _output_size(*fnames):
+    return sum(os.path.getsize(f) for f in fnames if os.path.exists(f))
+
+def ndi_column_names(fname, sensors, subcolumns):
     '''
-    Read data produced by NDI WaveFront software
-    skip empty columns, sensor not OK data set to 'nan'
+    Make the column names for a file produced by NDI WaveFront software,
+    checking that the number of sensors matches the file header
 
-    Input 
-        mydir- directory where biteplate file will be found 
-        file_name - name of a biteplate calibration recording
+    Input
+        fname - path of the .tsv file
         sensors - a list of sensors in the recording
         subcolumns - a list of info to be found for each sensor
-      
-    Output  
-        df - a pandas dataframe representation of the whole file
-    '''
-
-    fname = os.path.join(mydir, file_name)
 
+    Output
+        better_head - a list of column names: 'time', then '{sensor}_{subcolumn}',
+            with empty columns in the file named 'EMPTY0', 'EMPTY1', ...
+    '''
     better_head = ['time'] + \
         ['{}_{}'.format(s, c) for s in sensors for c in subcolumns]
 
@@ -46,41 +65,696 @@ def read_ndi_data(mydir, file_name,sensors,subcolumns):
         raise ValueError("too few sensors are specified")
     if ncol_file < ncol_sens:
         raise ValueError("too many sensors are specified")
+    return better_head
+
+def subcolumn_dtype(subcolumn, dtype=np.float64):
+    '''
+    the dtype to use when reading a sensor subcolumn:
+        the repeated tool ID and the state strings are categorical,
+        frame numbers are (nullable) integers, since a channel with no sensor plugged in
+        has empty columns, and everything else (quaternions, xyz) is dtype
+    '''
+    c = subcolumn.lower()
+    if c in ('id', 'state'):
+        return 'category'
+    if c == 'frame':
+        return 'Int64'
+    return dtype
+
+def _cache_key(fname, sensors, subcolumns, fields, dtype, keep=None):
+    '''a key that changes whenever the file or the way we parse it changes'''
+    st = os.stat(fname)
+    config = [CACHE_VERSION, os.path.abspath(fname), st.st_size, st.st_mtime_ns,
+              list(sensors), list(subcolumns), fields and list(fields), np.dtype(dtype).str]
+    if keep is not None:
+        config.append(list(keep))
+    return hashlib.sha1(json.dumps(config).encode()).hexdigest()
+
+def _cache_load(entry):
+    '''
+    rebuild a dataframe from a cache entry written by _cache_store,
+    or return None if there is no (complete) entry
+    '''
+    import pandas as pd
+    # an entry that is missing, being written or pruned, or truncated reads as no entry,
+    # and the caller parses the file again
+    try:
+        with open(os.path.join(entry, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        os.utime(os.path.join(entry, 'meta.json'))   # mark as recently used
+        # copy-on-write memory maps: callers may modify the dataframe, the cache stays intact
+        blocks = {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='c')
+                  for name in meta['blocks']}
+    except (OSError, ValueError):
+        return None
+    # each block becomes one pandas block without being copied (copy=False), so the
+    # numeric columns stay memory mapped; only the columns that are converted are new
+    frames = []
+    for name, block in blocks.items():
+        names = sorted((c for c in meta['columns'] if meta['layout'][c][0] == name),
+                       key=lambda c: meta['layout'][c][1])
+        frames.append(pd.DataFrame(block, columns=names, copy=False))
+    df = pd.concat(frames, axis=1) if len(frames) > 1 else frames[0] if frames else pd.DataFrame()
+    for c in meta['columns']:
+        name, i, kind, categories = meta['layout'][c]
+        if kind == 'numeric':
+            continue
+        vals = blocks[name][:, i]
+        if categories is None:   # nullable integers, stored as float
+            vals = pd.array(vals, dtype='Float64').astype(kind)
+        else:
+            vals = pd.Categorical.from_codes(vals, categories)
+            if kind != 'category':   # plain string columns go back to their own dtype
+                vals = pd.Series(vals).astype(object).astype(kind).values
+        df[c] = vals
+    df = df[meta['columns']]
+    df.attrs.update(meta['attrs'])
+    return df
+
+def _cache_store(entry, df):
+    '''
+    write a dataframe into the cache: one 2d .npy block per dtype (frames x columns),
+    string columns stored as integer codes, plus a meta.json describing the layout
+    '''
+    import pandas as pd
+    groups = {}
+    layout = {}
+    for c in df.columns:
+        col = df[c]
+        if isinstance(col.dtype, pd.api.extensions.ExtensionDtype) and \
+                pd.api.types.is_integer_dtype(col.dtype):   # nullable integers: store as float, nan for NA
+            kind, vals, categories = str(col.dtype), col.to_numpy(dtype=np.float64, na_value=np.nan), None
+        elif not pd.api.types.is_numeric_dtype(col.dtype):  # strings: store the codes
+            cat = col.astype('category').cat
+            kind = 'category' if isinstance(col.dtype, pd.CategoricalDtype) else str(col.dtype)
+            vals, categories = cat.codes.values.astype(np.int32), list(cat.categories)
+        else:
+            kind, vals, categories = 'numeric', col.values, None
+        name = 'block_' + np.dtype(vals.dtype).name
+        group = groups.setdefault(name, [])
+        layout[c] = [name, len(group), kind, categories]
+        group.append(vals)
+    meta = {'columns': list(df.columns), 'blocks': list(groups), 'layout': layout,
+            'attrs': _jsonable(df.attrs)}
 
-    df = pd.read_csv(fname, sep='\t', index_col = False,
+    tmp = '{}.tmp{}'.format(entry, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    for name, group in groups.items():
+        np.save(os.path.join(tmp, name + '.npy'), np.column_stack(group))
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:  # written last: marks the entry complete
+        json.dump(meta, f)
+    try:
+        os.rename(tmp, entry)
+    except OSError:   # another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def _cache_evict(cdir, max_bytes):
+    '''remove the least recently used cache entries until the cache fits in max_bytes'''
+    entries = []
+    for e in os.scandir(cdir):
+        meta = os.path.join(e.path, 'meta.json')
+        if not e.is_dir() or not os.path.exists(meta):
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(e.path))
+        entries.append((os.stat(meta).st_mtime, size, e.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def clear_cache(cdir=None):
+    '''remove all of the cached parsed recordings'''
+    cdir = cdir or cache_dir
+    if cdir and os.path.isdir(cdir):
+        shutil.rmtree(cdir)
+
+def _read_csv_args(fname, sensors, subcolumns, fields, dtype, keep=None):
+    '''the columns we will get and the pd.read_csv arguments for reading an NDI .tsv file'''
+    better_head = ndi_column_names(fname, sensors, subcolumns)
+    kwargs = dict(sep='\t', index_col = False,
         header=None,            # The last three parameters
         skiprows=1,             # are used to override
         names=better_head       # the existing file header.
     )
+    if fields is None and keep is None:
+        if np.dtype(dtype) != np.float64:   # no float64 columns at all (see read_ndi_data)
+            kwargs['dtype'] = {'{}_{}'.format(s, c): subcolumn_dtype(c, dtype)
+                               for s in sensors for c in subcolumns}
+        return better_head, kwargs
+
+    fields = subcolumns if fields is None else fields
+    keep = sensors if keep is None else keep
+    missing = [c for c in fields if c not in subcolumns] + [s for s in keep if s not in sensors]
+    if missing:
+        raise ValueError("unknown fields or sensors: {}".format(' '.join(missing)))
+    usecols = ['time'] + ['{}_{}'.format(s, c) for s in keep for c in fields]
+    dtypes = {'{}_{}'.format(s, c): subcolumn_dtype(c, dtype) for s in keep for c in fields}
+    dtypes['time'] = np.float64
+    kwargs.update(usecols=usecols,  # only parse the columns we need
+                  dtype=dtypes)
+    return usecols, kwargs
+
+# The largest difference (mm) between the xyz values of the float32 and float64 paths
+# (read_ndi_data(..., dtype=np.float32) through rotate_referenced_data or head_correct_data).
+# float32 keeps 24 bits, a relative error of 6e-8, or about 3e-5 mm at 500 mm from the
+# transmitter; the few roundings of a rotation and translation stay well under 1e-3 mm,
+# the precision with which WaveFront writes positions.  Quaternions are written with 7
+# decimals, and float32 holds them to within 6e-8.
+FLOAT32_ERROR = 1e-3
 
-    for s in sensors:   # clean up the data - xyz are nan if state is not ok
-        state = '{}_state'.format(s)
-        if str(df.loc[0,state])=='nan':  # here skipping non-existant sensors,
-            continue            # perhaps a cable not plugged in
-        locx = '{}_x'.format(s)
-        locz = '{}_z'.format(s)
-        cols = list(df.loc[:,locx:locz])
+# Missing tools have this in every numeric field, not just a state other than OK
+SENTINEL = -3.697314E28
+
+@instrumented('mask', lambda present, a: _frame_counts(a['df']))
+def mask_bad_states(df, sensors, subcolumns, present=None):
+    '''
+    clean up the data - quaternions and xyz are set to nan (in place) where the state is
+    not OK or the values are the sentinel NDI writes for a missing tool.  All of the sensors
+    are done in one pass over a (frames, sensors, fields) block.
+    
+    Input
+        df - a dataframe (or a chunk of rows of one) read from an NDI .tsv file
+        sensors - a list of sensors in the recording
+        subcolumns - a list of info to be found for each sensor
+        present - the sensors that exist in the recording.  If None, sensors with no state
+            in the first row of df are taken to be missing (perhaps a cable not plugged in)
+            and are left alone.
         
-        df.loc[df.loc[:,state]!="OK",cols]=[np.nan,np.nan,np.nan]   
+    Output
+        present - the list of sensors that exist, to pass in with later chunks of the file
+        
+        The number of bad frames of each present sensor is put in df.attrs['dropouts'].
+        A ValueError is raised if a state or Q0...Tz column is in df for some of the
+        present sensors but not for others.
+    '''
+    if present is None:
+        present = [s for s in sensors if '{}_state'.format(s) not in df
+                   or str(df['{}_state'.format(s)].iloc[0]) != 'nan']
+    # the fields that are in df for any of the sensors must be there for all of them
+    fields = [c for c in subcolumns if c.lower() not in ('id', 'frame', 'state')
+              and any('{}_{}'.format(s, c) in df for s in present)]
+    cols = ['{}_{}'.format(s, c) for s in present for c in fields]
+    states = ['{}_state'.format(s) for s in present]
+    if not any(c in df for c in states):
+        states = []
+    missing = [c for c in cols + states if c not in df]
+    if missing:
+        raise ValueError("the sensors do not all have the same columns; missing: {}".format(
+            ' '.join(missing)))
+    if not cols:
+        df.attrs['dropouts'] = {s: 0 for s in present}
+        return present
+
+    block = df.loc[:, cols].to_numpy(copy=True).reshape(len(df), len(present), len(fields))
+    bad = (block <= SENTINEL / 2).any(axis=2)    # frames, sensors
+    if states:
+        bad |= (df.loc[:, states].to_numpy() != "OK")
+    block[bad] = np.nan
+    df.loc[:, cols] = block.reshape(len(df), -1)
+    df.attrs['dropouts'] = dict(zip(present, bad.sum(axis=0).tolist()))
+    return present
+
+@instrumented('parse', lambda df, a: _frame_counts(df,
+    os.path.getsize(os.path.join(a['mydir'], a['file_name']))))
+def read_ndi_data(mydir, file_name,sensors,subcolumns, fields=None, dtype=np.float64, cache=True,
+                  keep=None):
+    '''
+    Read data produced by NDI WaveFront software
+    skip empty columns, sensor not OK data set to 'nan'
+
+    Input 
+        mydir- directory where biteplate file will be found 
+        file_name - name of a biteplate calibration recording
+        sensors - a list of sensors in the recording
+        subcolumns - a list of info to be found for each sensor
+        fields - optional list of the subcolumns to keep, e.g. ['state','x','y','z'].
+            When given, only the time column and these subcolumns are parsed,
+            with explicit dtypes (see subcolumn_dtype) instead of type inference.
+        keep - optional list of the sensors to keep (all of the sensors in the file must
+            still be given in sensors); only their columns are parsed
+        dtype - float type of the quaternion and xyz fields (np.float64 or np.float32).
+            With np.float32 the data take half the memory, and rotate_referenced_data,
+            head_correct_data and save_rotated keep them in float32 (see FLOAT32_ERROR).
+        cache - if True (and ema.cache_dir is set), keep a binary copy of the parsed data
+            and use it on later reads; the copy is keyed by the file's path, size and
+            modification time and by the sensors/subcolumns/fields/dtype arguments
+      
+    Output  
+        df - a pandas dataframe representation of the whole file
+            (or of the time column and the requested fields)
+            df.attrs['dropouts'] has the number of bad frames of each sensor
+            df.attrs['source'] is the path of the file
+    '''
+    import pandas as pd
+
+    fname = os.path.join(mydir, file_name)
+    entry = None
+    if cache and cache_dir:
+        entry = os.path.join(cache_dir, _cache_key(fname, sensors, subcolumns, fields, dtype, keep))
+        df = _cache_load(entry)
+        if df is not None:
+            df.attrs['source'] = fname
+            return df
+
+    usecols, kwargs = _read_csv_args(fname, sensors, subcolumns, fields, dtype, keep)
+    df = pd.read_csv(fname, **kwargs)
+    if list(df.columns) != usecols:   # usecols keeps the file order, not ours
+        df = df.loc[:, usecols]
+    df.attrs['source'] = fname
+    mask_bad_states(df, sensors if keep is None else keep, subcolumns)
+
+    if entry is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            _cache_store(entry, df)
+            _cache_evict(cache_dir, cache_max_bytes)
+        except OSError:   # an unwritable cache should never stop us reading data
+            pass
     return df
 
-def get_referenced_rotation(df):
+def iter_ndi_data(mydir, file_name, sensors, subcolumns, chunksize=10000, fields=None, dtype=np.float64):
+    '''
+    Read data produced by NDI WaveFront software a chunk of rows at a time, so that
+    memory use does not depend on the length of the recording.
+    The chunks are the same as the rows of read_ndi_data (sensor not OK data set to 'nan').
+
+    Input
+        as for read_ndi_data, plus
+        chunksize - the number of rows (frames) in each chunk
+
+    Output
+        yields dataframes of up to chunksize rows, indexed by row number in the file
+    '''
+    import pandas as pd
+    fname = os.path.join(mydir, file_name)
+    usecols, kwargs = _read_csv_args(fname, sensors, subcolumns, fields, dtype)
+    present = None
+    with pd.read_csv(fname, chunksize=chunksize, **kwargs) as reader:
+        for chunk in reader:
+            if list(chunk.columns) != usecols:
+                chunk = chunk.loc[:, usecols]
+            chunk.attrs['source'] = fname
+            present = mask_bad_states(chunk, sensors, subcolumns, present)
+            yield chunk
+
+class NDIData(object):
+    '''
+    A representation of NDI Wave tsv data.
+    
+    Instantiate the NDIData object with the path to a .tsv file and mapping of
+    sensor names to channel index in the .tsv file. The .tsv file is expected to
+    have one (time) column at the left, followed by repetitions of sets
+    of columns consisting of a 'State' column (and possibly others, e.g.
+    channel name and frame identifier) followed by columns Q0, Qx, Qy, Qz, Tx, Ty, Tz
+    in exactly that order. These repetitions are expected to occur regularly
+    with no exception, other than the possibility of empty columns identified
+    in the header with ' ', which are ignored. The Q0...Tz columns may have
+    suffixes appended to them, either in the .tsv file or as a side effect of
+    `read_csv`.
+    
+    The sensor map is a dictionary of the form {'sensor_name': idx, ...}, with the
+    index 0 indicating the first repetition of Q0...Tz columns and index 1 for the
+    second repetition.
+    
+    By default the 'State' values are processed to replace Q0...Tz values with
+    `Nan` for any sensor-frame that is not 'OK'. Replacement occurs automatically
+    when the `NDIData` object is instantiated unless `replace_bad` is set to
+    `False`.
+    
+    Access to the .tsv data is available as a dataframe via the `df` attribute:
+    
+    ```
+    tsv = NDIData(tsvpath, sensormap)
+    tsv.df
+    ```
+    
+    The Q0...Tz values of all sensors are held once, as a contiguous 3d ndarray
+    in the `qt` attribute, with dimensions 0) frame index (time); 1) sensors (channel
+    index); 2) Q0...Tz. Convenience methods are provided to access it for all sensors or a
+    set of sensors. Use `qtvals` to return columns [`Q0`, `Qx`, `Qy`, `Qz`,
+    `Tx`, `Ty`, `Tz`] for a given set of sensors. Use `qvals` to return only
+    [`Q0`, `Qx`, `Qy`, `Qz`], and use `tvals` to return only [`Tx`, `Ty`, `Tz`] for
+    the given sensors.
+    
+    ```
+    # Return 3d ndarray (axes: time, sensor, Q0...Tz)
+    tsv.qtvals()                          # Return Q0, Qx, Qy, Qz, Tx, Ty, Tz for all sensors
+    tsv.qvals(['nasion', 'leftMastoid'])  # Return Q0, Qx, Qy, Qz for two sensors
+    tsv.tvals(['nasion', 'leftMastoid'])  # Return Tx, Ty, Tz for two sensors
+    tsv.tvals('nasion', start=0.5, end=1.0)
+    ```
+    
+    Time windows (`start`, `end`) are found by binary search on the time column, which
+    is expected to be increasing. For all sensors, one sensor, or sensors at evenly
+    spaced channels (e.g. adjacent ones) the returned arrays are views into `qt`, so
+    getting a window does not copy it; modify a copy if the data should not change.
+    Other sensor lists are gathered into a new array, of the window only.
+    
+    Only the other columns (time, State, tool ID, Frame) are kept as a dataframe; `df`
+    puts them together with a copy of the Q0...Tz values of `qt` each time it is used, so
+    changes to it are not kept (use `replace_columns`).
+    '''
+
+    def __init__(self, tsvname, sensormap, replace_bad=True, time_col='Wav Time', dtype=np.float64):
+        '''dtype is the float type of the Q0...Tz values, np.float32 to halve their memory.'''
+        import pandas as pd
+        df = pd.read_csv(
+            tsvname,
+            sep='\t',
+            # Skip empty columns, which have a whitespace-only header.
+            usecols=lambda head: head != ' ',
+        )
+        self.columns = df.columns   # all of the columns, in the order of the file
+        self.sensormap = sensormap
+        self.rev_sensormap = {v: k for k, v in sensormap.items()}
+        self.time_col = time_col
+        self.time = df[time_col].to_numpy(dtype=np.float64)
+        if np.any(np.diff(self.time) < 0):
+            raise ValueError("the {} column is not in increasing order".format(time_col))
+        qtcols = self.columns[self.qtindexes('QT')]
+        self.qt = np.ascontiguousarray(df.loc[:, qtcols].to_numpy(dtype=dtype)).reshape(len(df), -1, 7)
+        self._other = df.drop(columns=qtcols)   # the Q0...Tz values are only kept in qt
+        if replace_bad is True:
+            self._set_bad_to_nan()
+        # TODO: relabel columns with sensor names?
+
+    def _set_bad_to_nan(self):
+        '''Set values of Q/T columns to NaN if corresponding 'State' column
+        is not 'OK'.'''
+        state = self._other.loc[:, self._other.columns.str.match('[Ss]tate')]
+        self.qt[(state != 'OK').to_numpy()] = np.nan  # bad should broadcast along Q0Txyz dimension
+
+    @property
+    def df(self):
+        '''The .tsv data as a dataframe: the other columns, with the Q0...Tz values of
+        self.qt copied in (so that changes to it are not kept, see replace_columns).'''
+        import pandas as pd
+        qtcols = self.columns[self.qtindexes('QT')]
+        qt = pd.DataFrame(self.qt.reshape(len(self.qt), -1), columns=qtcols, index=self._other.index)
+        return pd.concat([self._other, qt], axis=1).loc[:, self.columns]
+    
+    def qtindexes(self, qt, sensors=None):
+        '''Return a list of column integer indexes in self.df for the Q/T columns for
+        given sensors. The Q/T columns for a given sensor are assumed to be
+        in the order Q0, Qx, Qy, Qz, Tx, Ty, Tz with no other columns
+        intervening.
+            
+        This should be robust whether the Q/T values have additional
+        suffixes or not, e.g. Q0, Q0.1, Q0.15, etc.
+            
+        The value of sensors should be a list of keys in self.sensormap.
+        If sensors is None, include all sensors.
+        '''
+
+        # Get indexes of all Q0/Tx columns.
+        qtmap = {'Q': 'Q0', 'T': 'Tx', 'QT': 'Q0'}
+        q0s = (
+            self.columns.str.match('^{:}'.format(qtmap[qt]))
+        ).nonzero()[0]
+
+        # Test our assumption that Q/T0 channels are equally-spaced.
+        if len(q0s) > 1 and np.diff(q0s).std() != 0:
+            msg = 'Q/T channels are not equally-spaced!\n'
+            raise RuntimeError(msg)
+
+        # Calculate the indexes of the selected Q0/Tx columns.
+        step = int(np.diff(q0s)[0]) if len(q0s) > 1 else 0
+        # First get sensor indexes, e.g. in range 0-15.
+        if sensors is None:  # Use all sensors.
+            snums = np.arange(len(q0s))
+        else:
+            snums = np.array([self.sensormap[n] for n in sensors])
+        # Multiply by step and add column offset from left.
+        snums = (snums * step) + q0s[0]
+        # Add the x,y,z column indexes and flatten the list.
+        width = {'Q': 4, 'T': 3, 'QT': 7}[qt]
+        return [int(n + i) for n in snums for i in range(width)]
+
+    def replace_columns(self, vals, qt, sensors=None):
+        '''Replace the Q/T values in self.qt (and so in self.df) with new values from an ndarray.
+        
+        Parameters
+        ----------
+        
+        vals: 2D or 3D ndarray
+            New values for replacement. If 3D, `vals` has axes (time, sensors, Q0...Tz)
+            and will be reshaped to 2D to match the dataframe column arrangement; the
+            latter two dimensions are collapsed. An input 2D array must have the same
+            axes arrangement as the reshaped 3D array.
+            
+        qt: str ('QT', 'Q', or 'T')
+            The kinds of new column data in `vals`. Use 'QT' if replacing all 'Q' and
+            'T' values. Use 'Q' if replacing only 'Q' values and 'T' if only 'T' values.
+            If `vals` is 3D, then the shape of second dimension must match the `qt`
+            value: {'QT': 7, 'Q': 4, 'T': 3}.
+            
+        sensors: list of str
+            List of sensor values in `vals`. For 3D `vals` the third axis must be the
+            same length as `sensors`.
+
+        Returns
+        -------
+        Returns True on success. Raises an error if assignment does not succeed.
+
+        '''
+        if len(vals) != len(self.qt):
+            msg = "Can't replace columns. New values are not equal in length to old.\n"
+            raise ValueError(msg)
+        try:
+            snums = slice(None) if sensors is None else [self.sensormap[n] for n in sensors]
+            self.qt[:, snums, self._qt_fields[qt]] = np.reshape(
+                vals, (len(vals), -1, self._qt_fields[qt].stop - self._qt_fields[qt].start))
+        except Exception:
+            msg = "Could not replace columns with new data.\n"
+            raise ValueError(msg)
+        return True
+
+    def sensor_mean(self, sensor):
+        '''Return the mean x, y, z for sensor, excluding NaN.'''
+        return np.nanmean(np.squeeze(self.tvals(sensor)), axis=0)
+
+    _qt_fields = {'QT': slice(0, 7), 'Q': slice(0, 4), 'T': slice(4, 7)}
+
+    def _sensor_index(self, sensors):
+        '''The index along the sensor axis of self.qt for sensors: a slice where the
+        channels are evenly spaced (so that indexing gives a view), otherwise a list.'''
+        if sensors is None:
+            return slice(None)
+        if isinstance(sensors, str):
+            sensors = [sensors]
+        snums = [self.sensormap[n] for n in sensors]
+        step = snums[1] - snums[0] if len(snums) > 1 else 1
+        if step > 0 and snums == list(range(snums[0], snums[-1] + 1, step)):
+            return slice(snums[0], snums[-1] + 1, step)
+        return snums
+
+    def _qt_getter(self, qt, sensors=None, start=None, end=None):
+        '''Get Q and/or T values. To be called by qtvals(), qvals(), tvals().'''
+        return self.qt[self.time_slice(start, end), self._sensor_index(sensors), self._qt_fields[qt]]
+        
+    def qtvals(self, sensors=None, start=None, end=None):
+        '''Return the Q0, Qx, Qy, Qz, Tx, Ty, Tz values for given sensors
+        as a 3d ndarray. If sensors is None, return all sensors.
+        
+        The dimensions are:
+            frame index (time)
+            sensors
+            0xyz,xyz coordinates
+        '''
+        return self._qt_getter('QT', sensors, start, end)
+
+    def qvals(self, sensors=None, start=None, end=None):
+        '''Return the Q0, Qx, Qy, Qz values for given sensors as a 3d ndarray.
+        If sensors is None, return all sensors.
+        
+        The dimensions are:
+            frame index (time)
+            sensors
+            0xyz values
+        '''
+        return self._qt_getter('Q', sensors, start, end)
+
+    def tvals(self, sensors=None, start=None, end=None):
+        '''Return the Tx, Ty, Tz values for given sensors as a 3d ndarray.
+        If sensors is None, return all sensors.
+        
+        The dimensions are:
+            frame index (time)
+            sensors
+            xyz coordinates
+        '''
+        return self._qt_getter('T', sensors, start, end)
+
+    def time_slice(self, start=None, end=None):
+        '''Return a slice of the rows where the time column is in the range specified
+        by `start` and `end` (see time_range_as_int_index), found by binary search.'''
+        lo = 0 if start is None else int(np.searchsorted(self.time, start, side='left'))
+        hi = len(self.time) if end is None else int(np.searchsorted(self.time, end, side='right'))
+        return slice(lo, max(lo, hi))
+
+    def time_range_as_int_index(self, start=None, end=None):
+        '''Return the 0-based integer indexes of the rows in self.df where the time column
+        is in the range specified by `start` and `end`.
+        
+        Parameters
+        ----------
+        
+        start: numeric
+            The start time for the returned range. Integer indexes for times greater than or
+            equal to `start` are returned. If `start` is not specified, 0.0 is the default.
+            
+        end: numeric
+            The end time for the returned range. Integer indexes for times less than or
+            equal to `end` are returned. If `end` is not specified, np.inf is the default.
+        '''
+        return np.arange(len(self.time))[self.time_slice(start, end)]
+
+    def time_range(self, start=None, end=None):
+        '''Return the time values for the range specified by `start` and `end`.'''
+        return self.time[self.time_slice(start, end)]
+
+class RunningStats(object):
+    '''
+    Count, mean, variance, min and max of some columns, accumulated a chunk of frames at
+    a time with nan values skipped, so that statistics of a long recording (or of a whole
+    session) are worked out in one pass and in constant memory.
+
+    Input
+        columns - the names of the columns, e.g. ['REF_x', 'REF_y', 'REF_z']
+
+    Accumulators of different chunks, files or worker processes can be combined with
+    merge (Chan et al.'s pairwise update), in any order, with the same result (to rounding)
+    as one accumulator fed all of the frames.
+
+        stats = RunningStats(cols)
+        for chunk in iter_ndi_data(...):
+            stats.update(chunk)
+        stats.mean_of(['OS_x', 'OS_y', 'OS_z'])
+    '''
+    def __init__(self, columns):
+        self.columns = list(columns)
+        n = len(self.columns)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)    # sum of squared differences from the mean
+        self.min = np.full(n, np.inf)    # inf and -inf until there are values
+        self.max = np.full(n, -np.inf)
+
+    def update(self, vals):
+        '''add the frames of vals: a dataframe with the columns, or a (frames, columns) array'''
+        if hasattr(vals, 'loc'):
+            vals = vals.loc[:, self.columns].to_numpy(dtype=float)
+        vals = np.asarray(vals, dtype=float).reshape(-1, len(self.columns))
+        good = np.isfinite(vals)
+        chunk = RunningStats(self.columns)
+        chunk.count = good.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunk.mean = np.where(good, vals, 0.).sum(axis=0) / chunk.count
+            chunk.m2 = np.where(good, (vals - chunk.mean) ** 2, 0.).sum(axis=0)
+        chunk.mean[chunk.count == 0] = 0.
+        chunk.min = np.fmin.reduce(vals, axis=0, initial=np.inf)
+        chunk.max = np.fmax.reduce(vals, axis=0, initial=-np.inf)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        '''add the frames accumulated by other (with the same columns) to these'''
+        if other.columns != self.columns:
+            raise ValueError("the accumulators have different columns")
+        n = self.count + other.count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(n > 0, other.count / n, 0.)
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * frac
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * frac
+        self.count = n
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        return self
+
+    @property
+    def var(self):
+        '''the sample variance of each column (nan if fewer than two values)'''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def _index(self, columns):
+        try:
+            return [self.columns.index(c) for c in columns]
+        except ValueError as err:
+            raise KeyError(str(err))
+
+    def mean_of(self, columns):
+        '''the means of some of the columns (nan where there were no values), like df.loc[:, columns].mean()'''
+        i = self._index(columns)
+        return np.where(self.count[i] > 0, self.mean[i], np.nan)
+
+    def var_of(self, columns):
+        '''the sample variances of some of the columns'''
+        return self.var[self._index(columns)]
+
+def ndi_stats(mydir, file_name, sensors, subcolumns, stat_sensors=None, chunksize=10000):
+    '''
+    the RunningStats of the x, y, z of some sensors in a recording, read a chunk at a
+    time (iter_ndi_data) so memory use does not depend on the length of the recording
+
+    Input
+        mydir, file_name, sensors, subcolumns - as for read_ndi_data
+        stat_sensors - the sensors to accumulate (default all of sensors)
+
+    Output
+        stats - a RunningStats with columns '{sensor}_x', '{sensor}_y', '{sensor}_z'
+    '''
+    stat_sensors = sensors if stat_sensors is None else stat_sensors
+    stats = RunningStats(['{}_{}'.format(s, c) for s in stat_sensors for c in 'xyz'])
+    fields = [c for c in subcolumns if c.lower() in ('state', 'x', 'y', 'z')]
+    for chunk in iter_ndi_data(mydir, file_name, sensors, subcolumns, chunksize, fields=fields):
+        stats.update(chunk)
+    return stats
+
+def _sensor_mean(data, cols):
+    '''the mean of the columns of a dataframe, or of a RunningStats, skipping nan'''
+    if isinstance(data, RunningStats):
+        return data.mean_of(cols)
+    return data.loc[:, cols].mean(skipna=True).values
+
+def _occlusal_points(df, protractor=False):
+    '''the origin (OS) and the second point (MS) of the occlusal plane in a biteplate recording'''
+    if (protractor):  # if we are using a protractor instead of a wax biteplate
+        RO = _sensor_mean(df, ['RO_x', 'RO_y', 'RO_z'])  # right occlusal (protractor)
+        LO = _sensor_mean(df, ['LO_x', 'LO_y', 'LO_z'])  # left occlusal
+
+        MS = _sensor_mean(df, ['FO_x', 'FO_y', 'FO_z'])  # front occlusal   
+        OS = (RO + LO)/2  # choose this as the origin of the space
+    else: 
+        MS = _sensor_mean(df, ['MS_x', 'MS_y', 'MS_z'])
+        OS = _sensor_mean(df, ['OS_x', 'OS_y', 'OS_z'])
+    return OS, MS
+
+def get_referenced_rotation(df, protractor=False):
     '''
     given a dataframe representation of a biteplate recording, find rotation matrix 
          to put the data on the occlusal plane coordinate system
 
     Input
-        df - a dataframe read from a biteplate calibration recording
+        df - a dataframe read from a biteplate calibration recording (or its RunningStats)
             sensor OS is the origin of the occlusal plane coordinate system
             sensor MS is located on the biteplate some distance posterior to OS
+        protractor - if True, a protractor was used instead of a wax biteplate: the origin
+            is halfway between sensors RO and LO, and sensor FO takes the place of MS
+            (as in get_desired_head_location)
 
     Output 
         OS - the origin of the occlusal plane coordinate system
         m - a rotation matrix
     '''
 
-    MS = df.loc[:, ['MS_x', 'MS_y', 'MS_z']].mean(skipna=True).as_matrix()
-    OS = df.loc[:, ['OS_x', 'OS_y', 'OS_z']].mean(skipna=True).as_matrix()
+    OS, MS = _occlusal_points(df, protractor)
     REF = np.array([0, 0, 0])
         
     ref_t = REF-OS   # the origin of this space is OS, we will rotate around this
@@ -99,7 +773,7 @@ def get_referenced_rotation(df):
 
     return OS, m
 
-def get_desired_head_location(df, protractor=False):  
+def get_desired_head_location(df, protractor=False, head_sensors=('REF', 'RMA', 'LMA')):  
     ''' get the desired positions of three points - nasion, right mastoid, left mastoid (REF, RMA, LMA)
         so that the translation and rotation of these points will correct for head movement, and put
         the data onto an occlusal plane coordinate system.  
@@ -107,33 +781,24 @@ def get_desired_head_location(df, protractor=False):
         The location of the occlusal plane is given by a bite-plate, and the triangle formed by REF (nasion), 
         OS (origin sensor), and MS (molar sensor), which are in the saggital plane.
         
-        Input - a dataframe that has points 
-            REF, RMA, LMA, OS, and MS
+        Input - a dataframe that has points (or a RunningStats of them, see ndi_stats)
+            REF, OS, and MS, and the head_sensors
+            head_sensors - the sensors fixed to the head that will be used for head correction,
+                any number (at least three) of them, e.g. ('REF', 'RMA', 'LMA', 'RHE', 'LHE')
             
         Output - 
-            desired positions of REF, RMA, and LMA
+            OS, then the desired position of each of the head sensors (by default REF, RMA, and LMA)
     '''
     # The relative locations of these is fixed - okay to operate on means
-    if (protractor):  # if we are using a protractor instead of a wax biteplate
-        RO = df.loc[:, ['RO_x', 'RO_y', 'RO_z']].mean(skipna=True).values  # right occlusal (protractor)
-        LO = df.loc[:, ['LO_x', 'LO_y', 'LO_z']].mean(skipna=True).values  # left occlusal
+    OS, MS = _occlusal_points(df, protractor)
 
-        MS = df.loc[:, ['FO_x', 'FO_y', 'FO_z']].mean(skipna=True).values  # front occlusal   
-        OS = (RO + LO)/2  # choose this as the origin of the space
-    else: 
-        MS = df.loc[:, ['MS_x', 'MS_y', 'MS_z']].mean(skipna=True).values
-        OS = df.loc[:, ['OS_x', 'OS_y', 'OS_z']].mean(skipna=True).values
-
-    REF = df.loc[:,['REF_x', 'REF_y', 'REF_z']].mean(skipna=True).values
-    RMA= df.loc[:, ['RMA_x', 'RMA_y', 'RMA_z']].mean(skipna=True).values
-    LMA = df.loc[:, ['LMA_x', 'LMA_y', 'LMA_z']].mean(skipna=True).values
+    REF = _sensor_mean(df, ['REF_x', 'REF_y', 'REF_z'])
+    head = [_sensor_mean(df, ['{}_x'.format(s), '{}_y'.format(s), '{}_z'.format(s)])
+            for s in head_sensors]
     
     # 1) start by translating the space so OS is at the origin
     ref_t = REF-OS   
     ms_t = MS-OS
-    rma_t = RMA-OS
-    lma_t = LMA-OS
-    os_t = np.array([0,0,0])
     
     # 2) now find the rotation matrix to the occlusal coordinate system
     z = cross(ms_t,ref_t)  # z is perpendicular to ms and ref vectors
@@ -147,11 +812,8 @@ def get_desired_head_location(df, protractor=False):
        
     m = np.array([x, y, z])    # rotion matrix directly
     
-    # 3) now rotate the mastoid points - using the rotation matrix
-    rma_t = dot(rma_t,m.T) 
-    lma_t = dot(lma_t,m.T)
-    
-    return OS, ref_t, rma_t, lma_t
+    # 3) now rotate the nasion and mastoid (and any other head) points - using the rotation matrix
+    return (OS,) + tuple(dot(h - OS, m.T) for h in head)
     
 def read_referenced_biteplate(my_dir,file_name,sensors,subcolumns):
     ''' 
@@ -166,9 +828,8 @@ def read_referenced_biteplate(my_dir,file_name,sensors,subcolumns):
         m - a rotation matrix based on the quaternion
     '''
 
-    bpdata = read_ndi_data(my_dir,file_name,sensors,subcolumns)
-    [OS,m] = get_rotation(bpdata)
-    return OS, m
+    cal = biteplate_calibration(my_dir,file_name,sensors,subcolumns)
+    return cal.origin, cal.m
 
 
 def read_3pt_biteplate(my_dir,file_name,sensors,subcolumns):
@@ -184,10 +845,135 @@ def read_3pt_biteplate(my_dir,file_name,sensors,subcolumns):
             (nasion, right mastoid, left mastoid)
     '''
 
-    bpdata = read_ndi_data(my_dir,file_name,sensors,subcolumns)
-    [REF, RMA, LMA] = get_desired_head_location(bpdata)
+    cal = biteplate_calibration(my_dir,file_name,sensors,subcolumns)
+    if cal.ideal_head is None:
+        raise ValueError("no REF, RMA and LMA data in the biteplate recording")
+    REF, RMA, LMA = cal.ideal_head
     return REF, RMA, LMA
 
+class Calibration(object):
+    '''
+    The calibration found from a biteplate recording: everything needed to put other
+    recordings into the occlusal plane coordinate system.
+
+    Attributes
+        origin - the origin of the occlusal plane coordinate system (get_referenced_rotation)
+        m - a rotation matrix (get_referenced_rotation)
+        ideal_head - (N, 3) desired positions of the head sensors, by default REF, RMA, LMA
+            (get_desired_head_location), or None if the biteplate recording has no usable
+            head sensors
+        head_sensors - the names of the sensors in ideal_head
+        source - the fingerprint of the biteplate recording and of the settings used to read
+            it (file, size, mtime_ns, sensors, subcolumns, protractor)
+
+    Calibrations are small, and are saved as json (save, load) next to the biteplate
+    recording by biteplate_calibration so they do not have to be worked out again.
+    '''
+    def __init__(self, origin, m, ideal_head=None, head_sensors=('REF', 'RMA', 'LMA'), source=None):
+        self.origin = np.asarray(origin, dtype=float)
+        self.m = np.asarray(m, dtype=float)
+        self.ideal_head = None if ideal_head is None else np.asarray(ideal_head, dtype=float)
+        self.head_sensors = list(head_sensors)
+        self.source = source or {}
+
+    def to_dict(self):
+        return _jsonable({'origin': self.origin, 'm': self.m, 'ideal_head': self.ideal_head,
+                          'head_sensors': self.head_sensors, 'source': self.source})
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, 'r') as f:
+            return cls(**json.load(f))
+
+def _biteplate_source(fname, sensors, subcolumns, protractor, head_sensors=('REF', 'RMA', 'LMA')):
+    st = os.stat(fname)
+    source = {'file': os.path.basename(fname), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+              'sensors': list(sensors), 'subcolumns': list(subcolumns), 'protractor': protractor}
+    if list(head_sensors) != ['REF', 'RMA', 'LMA']:   # so that older .cal files still match
+        source['head_sensors'] = list(head_sensors)
+    return source
+
+_calibrations = {}   # biteplate calibrations already worked out in this process
+
+def biteplate_calibration(mydir, file_name, sensors, subcolumns, protractor=False,
+                          head_sensors=('REF', 'RMA', 'LMA')):
+    '''
+    get the calibration (a Calibration) from a biteplate recording, working it out only
+    if it has not been worked out before for this version of the file and these settings.
+    It is kept in memory, and saved next to the recording as name.cal.
+
+    Input 
+        mydir- directory where biteplate file will be found 
+        file_name - name of a biteplate calibration recording
+        sensors - a list of sensors in the recording
+        subcolumns - a list of info to be found for each sensor
+        protractor - passed on to get_referenced_rotation and get_desired_head_location
+        head_sensors - the sensors to find the ideal head positions of (get_desired_head_location)
+
+    Output
+        cal - a Calibration
+    '''
+    fname = os.path.join(mydir, file_name)
+    source = _biteplate_source(fname, sensors, subcolumns, protractor, head_sensors)
+    key = (os.path.abspath(fname), json.dumps(source))
+    if key in _calibrations:
+        return _calibrations[key]
+
+    calname = os.path.splitext(fname)[0] + '.cal'
+    try:
+        cal = Calibration.load(calname)
+    except (OSError, ValueError, TypeError):
+        cal = None
+    if cal is None or cal.source != source:
+        bpdata = ndi_stats(mydir, file_name, sensors, subcolumns)   # only the means are needed
+        OS, m = get_referenced_rotation(bpdata, protractor)
+        ideal_head = None
+        try:
+            with np.errstate(all='ignore'):   # e.g. no mastoid sensors in a 6D reference recording
+                head = np.array(get_desired_head_location(bpdata, protractor, head_sensors)[1:])
+            if np.isfinite(head).all():
+                ideal_head = head
+        except KeyError:
+            pass
+        cal = Calibration(OS, m, ideal_head, head_sensors, source=source)
+        try:
+            cal.save(calname)
+        except OSError:
+            pass
+    _calibrations[key] = cal
+    return cal
+
+def rotate_points(xyz, m, origin, out=None):
+    '''
+    translate and rotate the points of all frames and sensors at once:  dot(xyz - origin, m.T)
+
+    Input
+        xyz - (frames, sensors, 3) array (or any (..., 3) array)
+        m - a rotation matrix, origin - the origin (get_referenced_rotation)
+        out - optional array like xyz for the result (it may be xyz itself)
+
+    Output
+        the rotated points, in the dtype of xyz
+    '''
+    xyz = np.asarray(xyz)
+    o, r = np.asarray(origin, dtype=xyz.dtype), np.asarray(m, dtype=xyz.dtype)
+    rows = xyz.reshape(len(xyz), -1) if xyz.ndim > 1 else xyz.reshape(1, -1)
+
+    # translate whole rows (frames x 3*sensors), which is faster than 3 values at a time,
+    # then rotate everything in one matrix product
+    moved = np.subtract(rows, np.tile(o, rows.shape[1] // 3),
+                        out=None if out is None else out.reshape(rows.shape))
+    result = np.dot(moved.reshape(-1, 3), np.ascontiguousarray(r.T)).reshape(xyz.shape)
+    if out is None:
+        return result
+    out[...] = result
+    return out
+
+@instrumented('rotate', lambda df, a: _frame_counts(df, int(df.memory_usage(index=False).sum())))
 def rotate_referenced_data(df,m,origin, sensors):
     ''' 
     This function can be used when NDI head correction is used.  All we need is a translation vector
@@ -200,48 +986,581 @@ def rotate_referenced_data(df,m,origin, sensors):
             specifically we exect to find columns with these names plus "_x", "_y" and "_z"
             
     Output
-        df - the dataframe with the xyz locations of the sensors translatedd and rotated
+        df - the dataframe with the xyz locations of the sensors translatedd and rotated,
+            and their orientations (q0, qx, qy, qz columns, if any) rotated (see rotate_orientations)
     '''
+    # all of the sensors are read as one (frames, sensors, 3) block, rotated together and
+    # put back into the dataframe in one assignment
+    cols = ['{}_{}'.format(s, c) for s in sensors for c in 'xyz']
+    points = df.loc[:, cols].to_numpy(copy=True).reshape(len(df), len(sensors), 3)
+    if "REF" in sensors:
+        points[:, list(sensors).index("REF")] = 0   # the reference is the origin of the NDI space
+    df.loc[:, cols] = rotate_points(points, m, origin, out=points).reshape(len(df), -1)
 
-    # TODO:  remove quaternion data, or fix it.
-    for s in sensors:  # read xyz one sensor at a time
-        locx = '{}_x'.format(s)
-        locz = '{}_z'.format(s)
-        cols = list(df.loc[:,locx:locz])  # get names of columns to read
+    _rotate_orientation_columns(df, sensors, m)
+    return df
 
-        points = df.loc[:,cols].values   # read data
-        if s=="REF":
-            points = [0,0,0]
-        points = points - origin      # translate
-        df.loc[:,cols] = dot(points,m.T) # rotate - put back in the dataframe
+def quaternion_multiply(a, b):
+    '''the Hamilton products a b of (..., 4) arrays of w, x, y, z quaternions (broadcast)'''
+    aw, ax, ay, az = np.moveaxis(a, -1, 0)
+    bw, bx, by, bz = np.moveaxis(b, -1, 0)
+    return np.stack([aw*bw - ax*bx - ay*by - az*bz,
+                     aw*bx + ax*bw + ay*bz - az*by,
+                     aw*by - ax*bz + ay*bw + az*bx,
+                     aw*bz + ax*by - ay*bx + az*bw], axis=-1)
 
-    return df
+def quaternion_from_matrix(R):
+    '''
+    the w, x, y, z quaternions (..., 4), with w >= 0, of (..., 3, 3) rotation matrices.
+    Each is found from the largest of its four components, so that it is accurate
+    for every angle.
+    '''
+    R = np.asarray(R, dtype=float)
+    tr = R[..., 0, 0] + R[..., 1, 1] + R[..., 2, 2]
+    d = np.stack([tr, R[..., 0, 0], R[..., 1, 1], R[..., 2, 2]], axis=-1)
+    big = np.argmax(np.nan_to_num(d, nan=0.), axis=-1)[..., np.newaxis]
+
+    # 4 q_i q_j from the sums and differences of the elements, then divide by 4 q_big
+    s = np.stack([
+        [1 + tr, R[..., 2, 1] - R[..., 1, 2], R[..., 0, 2] - R[..., 2, 0], R[..., 1, 0] - R[..., 0, 1]],
+        [R[..., 2, 1] - R[..., 1, 2], 1 + 2*R[..., 0, 0] - tr, R[..., 0, 1] + R[..., 1, 0], R[..., 0, 2] + R[..., 2, 0]],
+        [R[..., 0, 2] - R[..., 2, 0], R[..., 0, 1] + R[..., 1, 0], 1 + 2*R[..., 1, 1] - tr, R[..., 1, 2] + R[..., 2, 1]],
+        [R[..., 1, 0] - R[..., 0, 1], R[..., 0, 2] + R[..., 2, 0], R[..., 1, 2] + R[..., 2, 1], 1 + 2*R[..., 2, 2] - tr],
+    ])                                              # 4, 4, ...
+    s = np.moveaxis(s, (0, 1), (-2, -1))            # ..., 4, 4
+    row = np.take_along_axis(s, big[..., np.newaxis], axis=-2)[..., 0, :]
+    with np.errstate(invalid='ignore'):
+        q = row / (2 * np.sqrt(np.take_along_axis(row, big, axis=-1)))
+    return q * np.where(q[..., :1] < 0, -1, 1)
+
+def rotate_orientations(q, R):
+    '''
+    apply the rotation of a correction to sensor orientations, for all frames and sensors at once
+
+    Input
+        q - (frames, sensors, 4) w, x, y, z orientation quaternions (Q0, Qx, Qy, Qz)
+        R - the (3, 3) matrix applied to every frame (rotate_referenced_data's m), or a
+            (frames, 3, 3) matrix for each frame (head_correct_and_rotate's R)
+
+    Output
+        rotated - (frames, sensors, 4) the quaternions R q, in the dtype of q, with w >= 0
+
+    The occlusal plane coordinate system is a mirror image of the NDI one (z negated, see
+    get_referenced_rotation), and a mirror image is not a rotation.  Where R mirrors, its
+    rotation part (R with its last row negated) is applied and the orientation is then
+    mirrored too, (w, x, y, z) -> (w, -x, -y, z): the orientation of a sensor whose local z
+    axis is also negated, so that a direction a in the sensor maps to R (q a) as (q' F a).
+    '''
+    q = np.asarray(q)
+    R = np.asarray(R, dtype=float)
+    with np.errstate(invalid='ignore'):   # frames without a fit have nan in R
+        mirror = np.linalg.det(R) < 0
+    flip = np.where(mirror[..., np.newaxis], [1., 1., -1.], 1.)
+    w, x, y, z = np.moveaxis(quaternion_from_matrix(R * flip[..., np.newaxis]), -1, 0)
+
+    # qr q as a matrix product: L q, with the rows of L negated that the mirror negates
+    L = np.stack([np.stack([w, -x, -y, -z], -1), np.stack([x, w, -z, y], -1),
+                  np.stack([y, z, w, -x], -1), np.stack([z, -y, x, w], -1)], -2)
+    L *= np.where(mirror[..., np.newaxis, np.newaxis], [[1.], [-1.], [-1.], [1.]], 1.)
+    dt = q.dtype if q.dtype.kind == 'f' else np.float64
+    L = L.astype(dt)
+    rotated = q.astype(dt, copy=False) @ np.swapaxes(L, -1, -2)
+    rotated *= np.copysign(np.ones(1, dtype=dt), rotated[..., :1])   # w >= 0
+    return rotated
+
+def _rotate_orientation_columns(df, sensors, R):
+    '''rotate the q0, qx, qy, qz columns of the sensors that have them, in place'''
+    have = [s for s in sensors if all('{}_q{}'.format(s, c) in df for c in '0xyz')]
+    if not have or len(df) == 0:
+        return
+    cols = ['{}_q{}'.format(s, c) for s in have for c in '0xyz']
+    q = df.loc[:, cols].to_numpy().reshape(len(df), len(have), 4)
+    df.loc[:, cols] = rotate_orientations(q, R).reshape(len(df), -1)
+
+def kabsch_frames(hdvals, idealhd, weights=None):
+    '''
+    find, for every frame at once, the rotation and translation that best move the
+    head sensors onto their desired locations (weighted Kabsch/Horn least squares fit)
+
+    Input
+        hdvals - (frames, N, 3) array: head sensors (e.g. REF, RMA, LMA) x xyz in each frame
+        idealhd - (N, 3) array: desired xyz locations of the same sensors, in the same order
+        weights - None (all 1), (N,) weight of each sensor, or (frames, N) weights for each
+            frame; a sensor that is nan in a frame has no weight in it
+
+    Output
+        R - (frames, 3, 3) rotation matrices
+        t - (frames, 3) translation vectors
+            so that idealhd ~= dot(hdvals[i], R[i].T) + t[i]
+            frames with fewer than three head sensors (with weight) get nan in R and t
+    '''
+    hdvals = np.asarray(hdvals, dtype=float)
+    idealhd = np.asarray(idealhd, dtype=float)
+    nframes, nsensors = hdvals.shape[:2]
+
+    R = np.full((nframes, 3, 3), np.nan)
+    t = np.full((nframes, 3), np.nan)
+
+    # svd does not converge on nan, so only fit the frames with three or more sensors present
+    w = np.ones(nsensors) if weights is None else np.asarray(weights, dtype=float)
+    w = np.where(np.isfinite(hdvals).all(axis=2), np.broadcast_to(w, (nframes, nsensors)), 0.)
+    good = (w > 0).sum(axis=1) >= 3
+    if not good.any():
+        return R, t
+    P = np.where(w[good, :, np.newaxis] > 0, hdvals[good], 0.)
+    w = w[good] / w[good].sum(axis=1, keepdims=True)
+
+    # 1) center both sets of points on their (weighted) centroids
+    p0 = np.einsum('fs,fsi->fi', w, P)
+    q0 = np.dot(w, idealhd)
+
+    # 2) weighted covariance of the centered points, one 3x3 matrix per frame
+    H = np.einsum('fs,fsi,fsj->fij', w, P - p0[:, np.newaxis, :],
+                  idealhd - q0[:, np.newaxis, :])
+
+    # 3) batched svd; flip the last axis where needed so that we get a rotation, not a reflection
+    U, S, Vt = np.linalg.svd(H)
+    d = np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+    Vt[:, 2, :] *= d[:, np.newaxis]
+    Rg = np.matmul(Vt.transpose(0, 2, 1), U.transpose(0, 2, 1))
+
+    R[good] = Rg
+    t[good] = q0 - np.einsum('fij,fj->fi', Rg, p0)
+    return R, t
+
+# The quality of each frame's head fit, made by fit_head_frames: 
+#   rms - the root mean square distance (mm) of the used head sensors from their desired
+#         locations after the fit (nan if the frame could not be fitted)
+#   max - the largest distance of any head sensor that was present, outliers included
+#   used - bit i is set if head sensor i was present and not an outlier
+#   n_used - the number of used head sensors
+#   outliers - the number of head sensors that were present but were outliers
+head_qa_dtype = np.dtype([('rms', np.float32), ('max', np.float32),
+                          ('used', np.uint32), ('n_used', np.uint8), ('outliers', np.uint8)])
 
-def head_correct_and_rotate(df,REF,RMA,LMA):
+def fit_head_frames(hdvals, idealhd, weights=None, outlier=None, iterations=3):
+    '''
+    fit the head sensors of every frame to their desired locations (kabsch_frames), with
+    the residual of each sensor worked out for all of the frames at once, and optionally
+    down-weight the sensors that do not fit
+
+    Input
+        hdvals, idealhd, weights - as for kabsch_frames (up to 32 head sensors)
+        outlier - None, or a distance (mm).  A sensor further than this from its desired
+            location after a fit has its weight in that frame multiplied by (outlier/distance)**2
+            and the frame is fitted again, iterations times, so a sensor that has slipped or
+            is noisy stops pulling the other sensors off.  This needs more than three
+            head sensors: three can always be fitted about equally well.
+
+    Output
+        R, t - as for kabsch_frames
+        qa - (frames,) array of head_qa_dtype
+    '''
+    hdvals = np.asarray(hdvals, dtype=float)
+    idealhd = np.asarray(idealhd, dtype=float)
+    nframes, nsensors = hdvals.shape[:2]
+    if nsensors > 32:
+        raise ValueError("at most 32 head sensors")
+    w0 = np.broadcast_to(np.ones(nsensors) if weights is None else np.asarray(weights, dtype=float),
+                         (nframes, nsensors))
+    present = np.isfinite(hdvals).all(axis=2) & (w0 > 0)
+
+    def residuals(R, t):
+        with np.errstate(invalid='ignore'):
+            fitted = np.matmul(hdvals, R.transpose(0, 2, 1)) + t[:, np.newaxis, :]
+            return norm(fitted - idealhd, axis=2)
+
+    w = w0
+    R, t = kabsch_frames(hdvals, idealhd, w)
+    r = residuals(R, t)
+    if outlier is not None:
+        for i in range(iterations):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                w = w0 * np.where(r > outlier, (outlier / r) ** 2, 1.)
+            R, t = kabsch_frames(hdvals, idealhd, w)
+            r = residuals(R, t)
+
+    with np.errstate(invalid='ignore'):
+        used = present & ~(r > outlier) if outlier is not None else present.copy()
+    used &= np.isfinite(r)
+    qa = np.zeros(nframes, dtype=head_qa_dtype)
+    qa['n_used'] = used.sum(axis=1)
+    qa['outliers'] = (present & np.isfinite(r) & ~used).sum(axis=1)
+    qa['used'] = np.dot(used, 1 << np.arange(nsensors, dtype=np.uint64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        qa['rms'] = np.sqrt(np.where(used, r ** 2, 0.).sum(axis=1) / qa['n_used'])
+        qa['max'] = np.where(present & np.isfinite(r), r, -np.inf).max(axis=1, initial=-np.inf)
+    qa['rms'][qa['n_used'] == 0] = np.nan
+    qa['max'][~np.isfinite(qa['max'])] = np.nan
+    return R, t, qa
+
+def head_correct_and_rotate(hdvals, idealhd, allvals, mirrored=True, weights=None, outlier=None,
+                            return_qa=False):
     '''This function uses the previously calculated desired locations of three sensors 
     on the head -- nasion (REF), right mastoid (RMA), and left mastoid (LMA) and based 
     on the locations of those sensors in each frame, finds a translation and rotation 
     for the frame's data, and then applies those to each sensor in that frame.
+
+    All of the frames are solved together (see kabsch_frames), so a whole recording is
+    corrected in one pass instead of one frame at a time.
+
+    Input
+        hdvals - (frames, H, 3) array of the head sensors (e.g. REF, RMA, LMA) xyz in each frame
+        idealhd - (H, 3) array of the desired locations of the head sensors
+        allvals - (frames, N, 3) array of the xyz of the sensors to be corrected
+        mirrored - True if idealhd is in the occlusal plane coordinate system of
+            get_desired_head_location, whose axes (x = z cross y) are a mirror image of
+            the NDI axes.  A head can be rotated, but not mirrored, onto the ideal triangle,
+            so the fit is made to the mirror image of idealhd and the result is mirrored
+            back (z negated).  False if idealhd is in a right handed coordinate system.
+        weights, outlier - the weight of each head sensor and the outlier distance (mm),
+            see fit_head_frames
+        return_qa - if True, also return the quality of each frame's fit
+
+    The fit is always made in float64; a float32 allvals is corrected in float32.
+
+    Output
+        rotated - (frames, N, 3) array of corrected sensor locations,
+            nan in frames where fewer than three head sensors were present
+        R - (frames, 3, 3) rotation matrix used for each frame (with its last row negated
+            if mirrored)
+        t - (frames, 3) translation vector used for each frame
+        qa - if return_qa, (frames,) array of head_qa_dtype (see fit_head_frames)
     '''
+    flip = np.array([1., 1., -1.]) if mirrored else np.ones(3)
     
-    # for each frame
     # 1) find the translation and rotation that will move the head into the occlusal coordinate system
     #              this is where we use Horns direct method of fitting to an ideal triangle
+    R, t, qa = fit_head_frames(hdvals, np.asarray(idealhd) * flip, weights, outlier)
+    R *= flip[:, np.newaxis]
+    t *= flip
 
-    R, t = rowan.mapping.kabsch(hdvals, idealhd)
-    q = rowan.from_matrix(R)  # Convert to quaternion
-
-    
     # 2) apply the translation and rotation to each sensor in the frame.
-    return rowan.rotate(q, allvals) + t
+    allvals = np.asarray(allvals)
+    dt = np.float32 if allvals.dtype == np.float32 else np.float64
+    rotated = np.einsum('fij,fsj->fsi', R.astype(dt), allvals.astype(dt, copy=False)) \
+        + t.astype(dt)[:, np.newaxis, :]
+    if return_qa:
+        return rotated, R, t, qa
+    return rotated, R, t
 
     ''' Question:  should we smooth the head position sensors prior to head correction?
         A reason to do this is that we can then avoid loosing any data due to calibration sensor dropout
         (assuming that missing frames are rare and can be interpolated).  Smoothing might also produce more 
         accurate data because we constrain our estimate of the the location of the head (a very slow moving 
         structure) by neighboring points in time.
+        
+        smooth_head_sensors does this, and head_correct_data(..., smooth={...}) applies it.
+    '''
+
+def fill_gaps(vals, max_gap):
+    '''
+    fill short runs of nan by linear interpolation along the first (time) axis,
+    for every channel at once
+
+    Input
+        vals - (frames, ...) array, e.g. (frames, 3, 3) head sensor xyz
+        max_gap - the longest run of nan frames (in a channel) that is filled;
+            longer gaps, and gaps at the start or end, are left as nan
+
+    Output
+        filled - a copy of vals with the short gaps filled
     '''
+    vals = np.asarray(vals)
+    flat = vals.reshape(len(vals), -1)
+    frames = np.arange(len(flat))[:, np.newaxis]
+    good = np.isfinite(flat)
+
+    # index of the last good frame at or before each frame, and of the next at or after it
+    prev = np.maximum.accumulate(np.where(good, frames, -1), axis=0)
+    nxt = np.minimum.accumulate(np.where(good, frames, len(flat))[::-1], axis=0)[::-1]
+    fill = ~good & (prev >= 0) & (nxt < len(flat)) & (nxt - prev - 1 <= max_gap)
+
+    filled = flat.copy()
+    f, c = np.nonzero(fill)
+    p, n = prev[f, c], nxt[f, c]
+    w = (f - p) / (n - p)
+    filled[f, c] = (1 - w) * flat[p, c] + w * flat[n, c]
+    return filled.reshape(vals.shape)
+
+def lowpass_kernel(cutoff, fs, numtaps=None):
+    '''
+    a linear phase (windowed sinc, Hamming window) low-pass filter with unit gain at 0 Hz
+
+    Input
+        cutoff - the cutoff frequency (Hz)
+        fs - the sample rate (Hz)
+        numtaps - the (odd) length of the filter, by default about two periods of the cutoff
+
+    Output
+        kernel - (numtaps,) filter coefficients
+    '''
+    if numtaps is None:
+        numtaps = int(2 * fs / cutoff)
+    numtaps += 1 - numtaps % 2   # odd, so that the filter has no delay
+    n = np.arange(numtaps) - numtaps // 2
+    kernel = np.sinc(2 * cutoff / fs * n) * np.hamming(numtaps)
+    return kernel / kernel.sum()
+
+def _lowpass(vals, kernel):
+    '''
+    filter along the first (time) axis, for every channel at once.  The data and the count
+    of good frames are filtered the same way and divided, so that nan frames and the ends of
+    the recording are left out of the weighted mean instead of spreading nan.
+    '''
+    half = len(kernel) // 2
+    flat = vals.reshape(len(vals), -1)
+    good = np.isfinite(flat)
+    pad = ((half, half), (0, 0))
+    x = np.pad(np.where(good, flat, 0), pad)
+    w = np.pad(good.astype(flat.dtype), pad)
+    window = lambda a: np.lib.stride_tricks.sliding_window_view(a, len(kernel), axis=0)
+    with np.errstate(all='ignore'):
+        smoothed = np.where(good, (window(x) @ kernel) / (window(w) @ kernel), np.nan)
+    return smoothed.reshape(vals.shape).astype(vals.dtype, copy=False)
+
+def _count_recovered(before, after):
+    '''the number of frames that were missing something before, and are complete after'''
+    axes = tuple(range(1, before.ndim))
+    return int((~np.isfinite(before).all(axis=axes) & np.isfinite(after).all(axis=axes)).sum())
+
+def smooth_head_sensors(hdvals, fs=200, cutoff=10., max_gap=10, numtaps=None):
+    '''
+    fill short dropouts in the head sensor trajectories and low-pass filter them, so that a
+    dropped reference sensor frame does not lose the frame for every sensor, and so that
+    the estimate of where the (slowly moving) head is uses the neighbouring frames
+
+    Input
+        hdvals - (frames, 3, 3) head sensor xyz (or any (frames, ...) array)
+        fs - the sample rate (Hz)
+        cutoff - the cutoff frequency (Hz) of the low-pass filter (see lowpass_kernel);
+            None to only fill gaps
+        max_gap - the longest dropout (frames) that is filled (see fill_gaps)
+        numtaps - the length of the low-pass filter
+
+    Output
+        smoothed - array like hdvals; frames still missing after filling stay nan, and are
+            left out of the filtering of the frames around them
+        recovered - the number of frames that had a missing head sensor and now have none
+    '''
+    hdvals = np.asarray(hdvals)
+    filled = fill_gaps(hdvals, max_gap)
+    recovered = _count_recovered(hdvals, filled)
+    if cutoff is None:
+        return filled, recovered
+    return _lowpass(filled, lowpass_kernel(cutoff, fs, numtaps)), recovered
+
+def iter_smoothed_head_sensors(chunks, fs=200, cutoff=10., max_gap=10, numtaps=None):
+    '''
+    smooth_head_sensors for a recording that arrives in chunks (e.g. from iter_ndi_data).
+    Each chunk is worked on together with enough of the frames before and after it that the
+    result is the same as smoothing the whole recording at once.
+
+    Input
+        chunks - an iterable of (frames, ...) head sensor arrays
+        the rest as for smooth_head_sensors
+
+    Output
+        yields (smoothed, recovered) for successive runs of frames; the output lags the input
+        by max_gap + 1 + numtaps/2 frames, and the total frames out equals the frames in
+    '''
+    kernel = None if cutoff is None else lowpass_kernel(cutoff, fs, numtaps)
+    context = (0 if kernel is None else len(kernel) // 2) + max_gap + 1  # frames either side
+                                                                         # that affect a frame
+    def smooth(buf, start, stop):
+        filled = fill_gaps(buf, max_gap)
+        smoothed = filled if kernel is None else _lowpass(filled, kernel)
+        return smoothed[start:stop], _count_recovered(buf[start:stop], filled[start:stop])
+
+    buf = None
+    done = 0      # frames at the start of buf that have already been yielded
+    for chunk in chunks:
+        buf = chunk if buf is None else np.concatenate([buf, chunk])
+        ready = len(buf) - context
+        if ready <= done:
+            continue
+        yield smooth(buf, done, ready)
+        keep = max(ready - context, 0)   # drop the frames that are no longer needed
+        buf, done = buf[keep:], ready - keep
+    if buf is not None and len(buf) > done:
+        yield smooth(buf, done, len(buf))
+
+@instrumented('head_correct', lambda r, a: dict(_frame_counts(a['df'], int(a['df'].memory_usage(index=False).sum())),
+    head_frames_recovered=a['df'].attrs.get('head_frames_recovered')))
+def head_correct_data(df, idealhd, sensors, head_sensors=('REF', 'RMA', 'LMA'), smooth=None,
+                      weights=None, outlier=None, return_qa=False):
+    '''
+    head correct a dataframe read by read_ndi_data, using head_correct_and_rotate
     
+    Input
+        df - a pandas dataframe read by read_ndi_data
+        idealhd - (H, 3) array of the desired locations of the head sensors,
+            e.g. np.array([REF, RMA, LMA]) from read_3pt_biteplate, or a Calibration's ideal_head
+        sensors - a list of the sensors to correct (columns with these names plus "_x", "_y", "_z")
+        head_sensors - the names of the head sensors, in the same order as idealhd
+        smooth - None, or a dict of smooth_head_sensors arguments (fs, cutoff, max_gap)
+            to fill gaps in and smooth the head sensors before they are used
+        weights, outlier - the weight of each head sensor and the outlier distance (mm),
+            see fit_head_frames
+        return_qa - if True, also return the quality of each frame's fit
+        
+    Output
+        df - the dataframe with the xyz locations of the sensors corrected, and their
+            orientations (q0, qx, qy, qz columns, if any) rotated (see rotate_orientations)
+        qa - if return_qa, (frames,) array of head_qa_dtype (see fit_head_frames)
+    '''
+    xyz = lambda s: ['{}_x'.format(s), '{}_y'.format(s), '{}_z'.format(s)]
+    hdvals = np.stack([df.loc[:, xyz(s)].values for s in head_sensors], axis=1)
+    if smooth is not None:
+        hdvals, recovered = smooth_head_sensors(hdvals, **smooth)
+        df.attrs['head_frames_recovered'] = recovered
+    cols = [c for s in sensors for c in xyz(s)]
+    allvals = df.loc[:, cols].values.reshape(len(df), len(sensors), 3)
+
+    rotated, R, t, qa = head_correct_and_rotate(hdvals, idealhd, allvals, weights=weights,
+                                                outlier=outlier, return_qa=True)
+    df.loc[:, cols] = rotated.reshape(len(df), -1)
+    _rotate_orientation_columns(df, sensors, R)
+    if return_qa:
+        return df, qa
+    return df
+
+# Head correction in two stages, so that a new biteplate calibration does not mean
+# reprocessing every recording:
+#   1) head_stabilize_data fits each frame's head sensors to a template of the head (the
+#      shape of the head sensors, found from the recording itself), which depends only on
+#      the recording.  The result, in "head space", is kept with save_head_space.
+#   2) the calibration is then one rigid transform of head space (head_space_calibration,
+#      or the biteplate's m and origin for 6D referenced recordings, whose data are in
+#      head space already), applied to all of the frames at once by transform_data.
+# This is not the same as head_correct_data's direct fit of each frame to the ideal head.
+# Fitting a frame to the template and then the template to the ideal head only gives the
+# frame's best fit to the ideal head if the frame's head sensors have the template's
+# shape, so the two differ by as much as the head sensors move apart from each other: by
+# under 1e-4 mm for a rigid synthetic head (0.05 mm of noise, synth_ndi), but by up to
+# 0.2 mm on the recordings in data/, whose head sensors are about 2 mm (rms) from the
+# template and 6-7 mm from the biteplate's ideal head.
+
+def head_space_template(hdvals, weights=None, outlier=None):
+    '''
+    the shape of the head sensors, in a coordinate system of their own
+
+    Input
+        hdvals - (frames, H, 3) array of the head sensors in each frame
+        weights, outlier - see fit_head_frames
+
+    Output
+        template - (H, 3) the mean position of each head sensor once every frame has been
+            fitted to the first frame that has all of them (outliers left out of the mean)
+    '''
+    hdvals = np.asarray(hdvals, dtype=float)
+    complete = np.flatnonzero(np.isfinite(hdvals).all(axis=(1, 2)))
+    if len(complete) == 0:
+        raise ValueError("no frame has all of the head sensors")
+    first = hdvals[complete[0]]
+    R, t, qa = fit_head_frames(hdvals, first - first.mean(axis=0), weights, outlier)
+    fitted = np.matmul(hdvals, R.transpose(0, 2, 1)) + t[:, np.newaxis, :]
+    used = (qa['used'][:, np.newaxis] >> np.arange(hdvals.shape[1], dtype=np.uint32)) & 1 == 1
+    fitted[~used] = np.nan
+    return np.nanmean(fitted, axis=0)
+
+def head_stabilize_data(df, sensors, head_sensors=('REF', 'RMA', 'LMA'), template=None,
+                        weights=None, outlier=None, smooth=None, return_qa=False):
+    '''
+    put the sensors of every frame into head space (the first stage of head correction):
+    each frame's head sensors are fitted to a template of the head, not to the ideal head
+    position of a biteplate, so the result does not depend on the calibration.  After
+    transform_data it is close to, not the same as, head_correct_data (see the note above).
+
+    Input
+        df, sensors, head_sensors, weights, outlier, smooth, return_qa - as for head_correct_data
+        template - (H, 3) head space positions of head_sensors, found from the recording
+            (head_space_template) if None
+
+    Output
+        df - the dataframe in head space, with df.attrs['head_template'] and
+            df.attrs['head_sensors'] for head_space_calibration
+        qa - if return_qa, (frames,) array of head_qa_dtype (see fit_head_frames)
+    '''
+    xyz = lambda s: ['{}_x'.format(s), '{}_y'.format(s), '{}_z'.format(s)]
+    hdvals = np.stack([df.loc[:, xyz(s)].values for s in head_sensors], axis=1)
+    if smooth is not None:
+        hdvals, recovered = smooth_head_sensors(hdvals, **smooth)
+        df.attrs['head_frames_recovered'] = recovered
+    if template is None:
+        template = head_space_template(hdvals, weights, outlier)
+    cols = [c for s in sensors for c in xyz(s)]
+    allvals = df.loc[:, cols].values.reshape(len(df), len(sensors), 3)
+
+    rotated, R, t, qa = head_correct_and_rotate(hdvals, template, allvals, mirrored=False,
+                                                weights=weights, outlier=outlier, return_qa=True)
+    df.loc[:, cols] = rotated.reshape(len(df), -1)
+    _rotate_orientation_columns(df, sensors, R)
+    df.attrs['head_template'] = np.asarray(template, dtype=float).tolist()
+    df.attrs['head_sensors'] = list(head_sensors)
+    if return_qa:
+        return df, qa
+    return df
+
+def head_space_calibration(template, idealhd, mirrored=True):
+    '''
+    the calibration of head space data (the second stage of head correction): the rigid
+    transform that best moves the head template onto the ideal head position of a biteplate
+
+    Input
+        template - (H, 3) head space positions of the head sensors (df.attrs['head_template'])
+        idealhd - (H, 3) desired locations of the same sensors (Calibration.ideal_head)
+        mirrored - see head_correct_and_rotate
+
+    Output
+        m, origin - for transform_data (or rotate_points): dot(xyz - origin, m.T)
+    '''
+    template = np.asarray(template, dtype=float)
+    _, R, t = head_correct_and_rotate(template[np.newaxis], idealhd, template[np.newaxis],
+                                      mirrored)
+    m = R[0]
+    return m, -np.dot(t[0], m)
+
+def transform_data(df, m, origin, sensors):
+    '''
+    move the sensors of every frame by the same rigid transform, dot(xyz - origin, m.T),
+    rotating their orientations (q0, qx, qy, qz columns, if any) too
+
+    Input
+        df - a pandas dataframe, e.g. head space data (read_head_space)
+        m, origin - e.g. from head_space_calibration, or a biteplate's m and origin
+        sensors - the sensors to move (columns with these names plus "_x", "_y", "_z")
+
+    Output
+        df - the dataframe, moved in place
+    '''
+    cols = ['{}_{}'.format(s, c) for s in sensors for c in 'xyz']
+    points = df.loc[:, cols].to_numpy(copy=True).reshape(len(df), len(sensors), 3)
+    df.loc[:, cols] = rotate_points(points, m, origin, out=points).reshape(len(df), -1)
+    _rotate_orientation_columns(df, sensors, m)
+    return df
+
+def save_head_space(mydir, fname, df, myext='head'):
+    '''
+    keep a recording's head space data (head_stabilize_data, or the data of a 6D
+    referenced recording as read) next to the original .tsv file, as name.head/: binary
+    arrays that read_head_space maps back into a dataframe without parsing
+
+    Output
+        entry - the path of the name.head directory
+    '''
+    entry = os.path.splitext(os.path.join(mydir, fname))[0] + '.' + myext
+    if os.path.isdir(entry):
+        shutil.rmtree(entry)
+    _cache_store(entry, df)
+    return entry
+
+def read_head_space(mydir, fname, myext='head'):
+    '''the dataframe saved by save_head_space for the recording fname (None if there is none)'''
+    return _cache_load(os.path.splitext(os.path.join(mydir, fname))[0] + '.' + myext)
+
+@instrumented('save', lambda r, a: dict(_frame_counts(a['df']), bytes=_output_size(
+    os.path.splitext(os.path.join(a['mydir'], a['fname']))[0] + '.' + a['myext'])))
 def save_rotated(mydir,fname,df,myext = 'ndi'):
     '''
     save the rotated data as *.ndi
@@ -259,3 +1578,169 @@ def save_rotated(mydir,fname,df,myext = 'ndi'):
     
     df.to_csv(processed, sep="\t", index=False)
 
+
+def _jsonable(obj):
+    '''convert numpy arrays and scalars (e.g. in a calibration) into plain json types'''
+    if isinstance(obj, dict):
+        return {k: _jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(v) for v in obj]
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    return obj
+
+@instrumented('save_binary', lambda header, a: dict(_frame_counts(a['df']),
+    bytes=_output_size(header, header + '.xyz', header + '.time', header + '.state')))
+def save_rotated_binary(mydir, fname, df, sensors, sample_rate=None, calibration=None,
+                        dtype=np.float32, myext='emab'):
+    '''
+    save the rotated data as fixed-layout binary arrays, which can be memory mapped
+    
+    Files written, next to the original .tsv file:
+        name.emab       - json header: sensor names, sample rate, calibration and array layout
+        name.emab.xyz   - sensor coordinates, dtype, shape (sensors, frames, 3); each sensor's
+                          trajectory is contiguous so it can be mapped on its own
+        name.emab.time  - float64 time of each frame
+        name.emab.state - uint8 (sensors, frames) index into the header's list of state
+                          strings, 255 where there was no state
+    
+    Input
+        mydir - directory where the data will be found
+        fname - the name of the original .tsv file
+        df - a pandas dataframe containing the processed/rotated data
+        sensors - the sensors to save, columns '{sensor}_x' etc. must be in df
+        sample_rate - frames per second, estimated from the time column if not given
+        calibration - a dict describing the calibration that was applied, e.g.
+            {'biteplate': name, 'origin': OS, 'm': m}, stored in the header
+        dtype - np.float32 or np.float64
+        
+    Output
+        header - the path of the header file
+    '''
+    import pandas as pd
+    name, ext = os.path.splitext(os.path.join(mydir, fname))
+    header = name + '.' + myext
+    dtype = np.dtype(dtype)
+
+    times = df.loc[:, 'time'].values.astype(np.float64)
+    if sample_rate is None:
+        sample_rate = float(1 / np.median(np.diff(times))) if len(times) > 1 else None
+    nframes = len(times)
+    
+    xyz = np.empty((len(sensors), nframes, 3), dtype=dtype)
+    state = np.full((len(sensors), nframes), 255, dtype=np.uint8)
+    states = []
+    for i, s in enumerate(sensors):
+        xyz[i] = df.loc[:, ['{}_x'.format(s), '{}_y'.format(s), '{}_z'.format(s)]].values
+        col = '{}_state'.format(s)
+        if col in df:
+            codes, uniques = pd.factorize(df.loc[:, col].astype(object))
+            for u in uniques:
+                if u not in states:
+                    states.append(u)
+            lookup = np.array([states.index(u) for u in uniques], dtype=np.uint8)
+            state[i, codes >= 0] = lookup[codes[codes >= 0]]
+
+    arrays = {
+        'xyz': {'file': os.path.basename(header) + '.xyz', 'dtype': dtype.str,
+                'shape': [len(sensors), nframes, 3]},
+        'time': {'file': os.path.basename(header) + '.time', 'dtype': np.dtype(np.float64).str,
+                 'shape': [nframes]},
+        'state': {'file': os.path.basename(header) + '.state', 'dtype': np.dtype(np.uint8).str,
+                  'shape': [len(sensors), nframes], 'values': states},
+    }
+    for a, vals in (('xyz', xyz), ('time', times), ('state', state)):
+        vals.tofile(os.path.join(os.path.dirname(header), arrays[a]['file']))
+    with open(header, 'w') as f:
+        json.dump({
+            'format': 'ema-binary', 'version': 1,
+            'source': os.path.basename(fname),
+            'sensors': list(sensors),
+            'sample_rate': sample_rate,
+            'nframes': nframes,
+            'calibration': _jsonable(calibration),
+            'arrays': arrays,
+        }, f, indent=1)
+    return header
+
+def read_rotated_binary(mydir, fname, sensors=None, myext='emab'):
+    '''
+    memory map data saved by save_rotated_binary.  Only the pages that are used are read,
+    so asking for one sensor does not read the others.
+
+    Input
+        mydir - directory where the data will be found
+        fname - the name of the original .tsv file (or of the header file)
+        sensors - the sensors to return, all sensors if None
+        
+    Output
+        header - the header dict (sensors, sample_rate, calibration, ...)
+        time - (frames,) memory mapped time of each frame
+        xyz - (frames, sensors, 3) coordinates; a memory mapped view for all sensors
+            or for a single sensor, a copy of just the requested sensors otherwise
+        state - (frames, sensors) uint8 codes into header['arrays']['state']['values']
+    '''
+    name, ext = os.path.splitext(os.path.join(mydir, fname))
+    with open(name + '.' + myext, 'r') as f:
+        header = json.load(f)
+    arrays = header['arrays']
+
+    def mapped(a, offset=0, shape=None):
+        info = arrays[a]
+        dt = np.dtype(info['dtype'])
+        return np.memmap(os.path.join(os.path.dirname(name), info['file']), dtype=dt, mode='r',
+                         offset=offset * dt.itemsize, shape=tuple(shape or info['shape']))
+
+    nframes = header['nframes']
+    times = mapped('time')
+    if sensors is None:
+        xyz = np.moveaxis(mapped('xyz'), 0, 1)
+        state = mapped('state').T
+    else:
+        idx = [header['sensors'].index(s) for s in sensors]
+        xyz = [mapped('xyz', i * nframes * 3, (nframes, 3)) for i in idx]
+        state = [mapped('state', i * nframes, (nframes,)) for i in idx]
+        if len(idx) == 1:
+            xyz, state = xyz[0][:, np.newaxis, :], state[0][:, np.newaxis]
+        else:
+            xyz, state = np.stack(xyz, axis=1), np.stack(state, axis=1)
+    return header, times, xyz, state
+
+@instrumented('rotate_file', lambda nframes, a: {'file': os.path.join(a['mydir'], a['fname']),
+    'rows': nframes, 'bytes': os.path.getsize(os.path.join(a['mydir'], a['fname']))})
+def rotate_referenced_file(mydir, fname, m, origin, sensors, subcolumns, chunksize=10000, myext='ndi',
+                           dtype=np.float64):
+    '''
+    read, rotate and save a recording a chunk at a time (iter_ndi_data, rotate_referenced_data
+    and save_rotated), so memory use stays the same however long the recording is.
+    The output file is the same, byte for byte, as the one made by the whole-file functions.
+
+    Input
+        mydir - directory where the data will be found
+        fname - the name of the original .tsv file
+        m, origin - the rotation matrix and origin found from the biteplate recording
+        sensors - a list of sensors in the recording
+        subcolumns - a list of info to be found for each sensor
+        chunksize - the number of frames to hold in memory at one time
+        dtype - float type of the quaternion and xyz fields (see read_ndi_data)
+
+    Output
+        nframes - the number of frames processed
+    '''
+    name,ext = os.path.splitext(os.path.join(mydir,fname))
+    processed = name + '.' + myext
+
+    # write to a temporary file, so that a failure part way through leaves no partial output
+    partial = processed + '.part'
+    nframes = 0
+    try:
+        with open(partial, 'w', newline='') as f:
+            for chunk in iter_ndi_data(mydir, fname, sensors, subcolumns, chunksize=chunksize, dtype=dtype):
+                chunk = rotate_referenced_data(chunk, m, origin, sensors)
+                chunk.to_csv(f, sep="\t", index=False, header=(nframes == 0))
+                nframes += len(chunk)
+        os.replace(partial, processed)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return nframes
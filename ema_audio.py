@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The audio (.wav) and settings (.wco) that WaveFront records along with each .tsv file,
+and time-aligned slices of audio and EMA data.
+
+    acq = Acquisition('data/knight_occlusal_001')
+    acq.frequency, acq.tools            # from the .wco file
+    t0, audio, ema_t, xyz = acq.slice(0.5, 1.0, sensors=['s3'])
+
+The .wav file is memory mapped, and the EMA data come from the binary output of
+ema.save_rotated_binary when there is one (memory mapped too), otherwise from the .tsv
+file (ema.NDIData).  So a slice reads about as much of the files as it returns, not the
+whole recording, and extracting many short tokens costs in proportion to their length.
+EMA frames are aligned to the audio by their 'Wav Time'.
+"""
+import os, struct, configparser
+import numpy as np
+import ema
+
+def read_wco(fname):
+    '''
+    read the settings file that WaveFront saves with a recording
+
+    Input
+        fname - path of the .wco file
+
+    Output
+        wco - a dict:
+            frequency - the EMA frame rate (Hz), from [TRACK_SETTINGS] Frequency
+            tools - a list with a dict for each tool in [TOOL_SETTINGS], in tool order:
+                label, type, dof, ref (bool), port, channel, and any other Tool_N_ settings
+            settings - all of the settings, {section: {name: value string}}
+    '''
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.optionxform = str   # keep the case of the names
+    with open(fname, 'r') as f:
+        parser.read_file(f)
+    settings = {s: dict(parser[s]) for s in parser.sections()}
+
+    tools = []
+    tool_settings = settings.get('TOOL_SETTINGS', {})
+    for i in range(int(tool_settings.get('NumberOfTools', 0))):
+        prefix = 'Tool_{}_'.format(i)
+        tool = {k[len(prefix):].lower(): v for k, v in tool_settings.items() if k.startswith(prefix)}
+        for k in ('type', 'dof', 'channel'):
+            if k in tool:
+                tool[k] = int(tool[k])
+        if 'physicalport' in tool:
+            tool['port'] = tool.pop('physicalport')
+        if 'ref' in tool:
+            tool['ref'] = tool['ref'].lower() == 'true'
+        tools.append(tool)
+    return {'frequency': float(settings['TRACK_SETTINGS']['Frequency']), 'tools': tools,
+            'settings': settings}
+
+_wav_formats = {(1, 8): np.uint8, (1, 16): np.int16, (1, 32): np.int32,
+                (3, 32): np.float32, (3, 64): np.float64}
+
+def map_wav(fname):
+    '''
+    memory map the samples of a .wav file, found by walking its RIFF chunks
+
+    Input
+        fname - path of the .wav file (PCM 8, 16 or 32 bit, or float)
+
+    Output
+        rate - the sample rate (Hz)
+        samples - a read-only (samples, channels) memmap; nothing is read from the file
+            until it is used
+    '''
+    with open(fname, 'rb') as f:
+        riff, size, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError("{} is not a .wav file".format(fname))
+        fmt = None
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                raise ValueError("no data chunk in {}".format(fname))
+            chunk, length = struct.unpack('<4sI', head)
+            if chunk == b'fmt ':
+                body = f.read(length)
+                tag, channels, rate, _, _, bits = struct.unpack('<HHIIHH', body[:16])
+                if tag == 0xFFFE:   # WAVE_FORMAT_EXTENSIBLE: the real format is in the subformat
+                    tag = struct.unpack('<H', body[24:26])[0]
+                fmt = (tag, channels, rate, bits)
+            elif chunk == b'data':
+                offset = f.tell()
+                break
+            else:
+                f.seek(length, 1)
+            if length % 2:   # chunks are padded to an even length
+                f.seek(1, 1)
+    if fmt is None:
+        raise ValueError("no fmt chunk in {}".format(fname))
+    tag, channels, rate, bits = fmt
+    if (tag, bits) not in _wav_formats:
+        raise ValueError("unsupported .wav format (format {}, {} bits)".format(tag, bits))
+    dtype = np.dtype(_wav_formats[(tag, bits)]).newbyteorder('<')
+    nsamples = min(length, os.path.getsize(fname) - offset) // (dtype.itemsize * channels)
+    samples = np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=(nsamples, channels))
+    return rate, samples
+
+class Acquisition(object):
+    '''
+    One acquisition: the .wco settings, the .wav audio and the EMA data, for slicing by time.
+
+    Input
+        base - the path of the acquisition without an extension, e.g. 'data/knight_no_ref_000'
+        sensormap - {'sensor_name': channel index, ...}, to read the .tsv file (see ema.NDIData);
+            not needed if there is a base.emab file (ema.save_rotated_binary), whose sensor
+            names are used
+        source - 'emab' or 'tsv' to choose where the EMA data come from, by default the
+            .emab file if there is one
+
+    The .wco file is read and the .wav file mapped when the Acquisition is made; the EMA
+    data are opened the first time they are used.
+    '''
+    def __init__(self, base, sensormap=None, source=None):
+        self.base = base
+        self.sensormap = sensormap
+        wco = read_wco(base + '.wco')
+        self.frequency = wco['frequency']
+        self.tools = wco['tools']
+        self.settings = wco['settings']
+        self.rate, self.audio = map_wav(base + '.wav')
+        if source is None:
+            source = 'emab' if os.path.exists(base + '.emab') else 'tsv'
+        self.source = source
+        self._ema = None
+
+    def _open_ema(self):
+        if self._ema is None:
+            mydir, fname = os.path.split(self.base)
+            if self.source == 'emab':
+                header, times, xyz, state = ema.read_rotated_binary(mydir, fname)
+                self._ema = (times, xyz, {s: i for i, s in enumerate(header['sensors'])})
+            else:
+                self._ema = ema.NDIData(self.base + '.tsv', self.sensormap)
+        return self._ema
+
+    @property
+    def ema_time(self):
+        '''the Wav Time of each EMA frame'''
+        data = self._open_ema()
+        return data[0] if isinstance(data, tuple) else data.time
+
+    def audio_slice(self, start, end):
+        '''
+        the audio between start and end (s)
+
+        Output
+            t0 - the time (s) of the first sample
+            audio - (samples, channels) view of the memory mapped samples
+        '''
+        i0 = max(int(np.ceil(start * self.rate)), 0)
+        i1 = min(int(np.floor(end * self.rate)) + 1, len(self.audio))
+        return i0 / self.rate, self.audio[i0:max(i0, i1)]
+
+    def ema_slice(self, start, end, sensors=None):
+        '''
+        the EMA xyz data of the frames with a Wav Time between start and end (s)
+
+        Output
+            times - (frames,) Wav Time of each frame
+            xyz - (frames, sensors, 3); from an .emab file only the requested frames of the
+                requested sensors are read
+        '''
+        data = self._open_ema()
+        if not isinstance(data, tuple):
+            window = data.time_slice(start, end)
+            return data.time[window], data.tvals(sensors, start, end)
+        times, xyz, index = data
+        lo = int(np.searchsorted(times, start, side='left'))
+        hi = max(lo, int(np.searchsorted(times, end, side='right')))
+        if sensors is None:
+            return times[lo:hi], xyz[lo:hi]
+        if isinstance(sensors, str):
+            sensors = [sensors]
+        # each sensor's trajectory is contiguous in the file, so read the window of each
+        return times[lo:hi], np.stack([xyz[lo:hi, index[s]] for s in sensors], axis=1)
+
+    def slice(self, start, end, sensors=None):
+        '''
+        time-aligned audio and EMA data between start and end (s)
+
+        Output
+            t0 - the time (s) of the first audio sample (the first at or after start)
+            audio - (samples, channels) audio, at t0 + np.arange(len(audio)) / rate
+            times - (frames,) Wav Time of the EMA frames
+            xyz - (frames, sensors, 3) EMA data
+        '''
+        t0, audio = self.audio_slice(start, end)
+        times, xyz = self.ema_slice(start, end, sensors)
+        return t0, audio, times, xyz
@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process a whole directory of EMA recordings without the GUI, using all of the cores.
+
+    python ema_batch.py /data/session --biteplate subj_biteplate_002.tsv
+    python ema_batch.py /data/session --biteplate subj_biteplate_002.tsv --head-correct
+
+Every .tsv file under the directory that is not a biteplate or palate recording is
+read, put into the occlusal plane coordinate system and saved next to the original
+(see ema.save_rotated).
+
+A manifest (.ema_manifest.json in the directory) records what each output was made
+from, so running again only processes new or changed recordings, recordings that
+failed, and everything if the calibration or the sensor setup changed.
+
+With --log, the time spent in each stage of each file is written to a json lines file
+(see ema_instrument), e.g. python ema_instrument.py run.jsonl to see where the time went.
+"""
+import os, re, sys, time, json, hashlib, argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from numpy.linalg import norm
+import ema, ema_instrument
+
+sensors = ["REF","UL","LL","JW","TT","TB","TD","TL","LC","UI","J","OS","MS","PL"]
+subcolumns = ["ID","frame","state","q0","qx","qy","qz","x","y","z"]
+skip_patterns = ["biteplate", "palate"]
+manifest_name = '.ema_manifest.json'
+
+def find_data_files(base_directory, skip=skip_patterns):
+    '''
+    find the recordings to process
+
+    Input
+        base_directory - the directory to search (including subdirectories)
+        skip - file names that contain one of these (ignoring case) are skipped,
+            e.g. the biteplate and palate recordings
+
+    Output
+        a sorted list of paths of .tsv files
+    '''
+    skipper = re.compile('|'.join(re.escape(p) for p in skip), re.IGNORECASE) if skip else None
+    found = []
+    for root, dirs, files in os.walk(base_directory):
+        for f in files:
+            base,ext = os.path.splitext(f)
+            if ext != '.tsv':
+                continue
+            if skipper and skipper.search(f):
+                continue
+            found.append(os.path.join(root, f))
+    return sorted(found)
+
+def calibrate(mydir, file_name, bpsensors, subcolumns, head_correct=False,
+              head_sensors=('REF', 'RMA', 'LMA'), head_weights=None, outlier=None):
+    '''
+    read a biteplate recording and make the calibration used by process_file
+
+    Input
+        mydir, file_name - the biteplate recording, or a calibration saved from one (.cal)
+        bpsensors - a list of the sensors in the biteplate recording
+        subcolumns - a list of info to be found for each sensor
+        head_correct - if False, the data were head corrected by the NDI software (6D reference)
+            and only need to be put on the occlusal plane; if True, find the ideal head
+            positions of head_sensors for frame by frame head correction
+        head_sensors - the sensors fixed to the head (three or more)
+        head_weights - optional weight of each head sensor, outlier - optional outlier
+            distance (mm), see ema.fit_head_frames
+
+    Output
+        calibration - a dict, either {'origin': OS, 'm': m} or
+            {'ideal_head': (N, 3) array, 'head_sensors': ['REF', 'RMA', 'LMA', ...]}
+            plus 'head_weights' and 'outlier' if they were given
+    '''
+    if file_name.endswith('.cal'):   # a saved ema.Calibration
+        cal = ema.Calibration.load(os.path.join(mydir, file_name))
+    else:
+        cal = ema.biteplate_calibration(mydir, file_name, bpsensors, subcolumns,
+                                        head_sensors=head_sensors)
+    if head_correct:
+        if cal.ideal_head is None:
+            raise ValueError("no {} data in the biteplate recording".format(', '.join(cal.head_sensors)))
+        calibration = {'ideal_head': cal.ideal_head, 'head_sensors': cal.head_sensors}
+        if head_weights is not None:
+            if len(head_weights) != len(cal.head_sensors):
+                raise ValueError("one weight is needed for each head sensor")
+            calibration['head_weights'] = np.asarray(head_weights, dtype=float)
+        if outlier is not None:
+            calibration['outlier'] = float(outlier)
+        return calibration
+    return {'origin': cal.origin, 'm': cal.m}
+
+def calibrate_head_space(data, calibration, sensors):
+    '''
+    apply a calibration to head space data (see ema.save_head_space): the biteplate's
+    rotation for 6D referenced data, or the fit of the head template to the ideal head
+    position for head corrected data (ema.head_space_calibration)
+    '''
+    template = data.attrs.get('head_template')
+    if 'ideal_head' in calibration:
+        if template is None:
+            raise ValueError("the head space data are 6D referenced; they need a biteplate "
+                             "rotation, not head correction")
+        if list(data.attrs['head_sensors']) != list(calibration['head_sensors']):
+            raise ValueError("the head space data were fitted with other head sensors ({})".format(
+                ' '.join(data.attrs['head_sensors'])))
+        m, origin = ema.head_space_calibration(template, calibration['ideal_head'])
+        return ema.transform_data(data, m, origin, sensors)
+    if template is not None:
+        raise ValueError("the head space data were head corrected; they need a head correction "
+                         "calibration")
+    return ema.rotate_referenced_data(data, calibration['m'], calibration['origin'], sensors)
+
+@ema_instrument.instrumented('file', lambda r, a: {'file': r['file'], 'rows': r['frames'],
+                                                   'ok': r['ok'], 'error': r['error']})
+def process_file(fname, sensors, subcolumns, calibration, myext='ndi', dtype=np.float64,
+                 head_space=False, recalibrate=False):
+    '''
+    read, correct and save one recording
+
+    Input
+        fname - path of the .tsv file
+        sensors - a list of sensors in the recording
+        subcolumns - a list of info to be found for each sensor
+        calibration - a dict made by calibrate()
+        dtype - np.float32 to read, correct and save in float32 (see ema.read_ndi_data)
+        head_space - if True, correct in two stages and keep the first, the recording in head
+            space (ema.save_head_space), so that it can be calibrated again without being
+            read and head corrected again (recalibrate)
+        recalibrate - if True, apply the calibration to the head space data kept by an
+            earlier head_space run, instead of reading the .tsv file
+
+    Output
+        result - a dict with keys
+            file - fname
+            ok - True if the file was processed and saved
+            error - the error message if not ok, otherwise None
+            frames - the number of frames processed
+            elapsed - the processing time in seconds
+            skipped - True if the output was already up to date (see process_directory)
+            input_hash - the sha1 of the contents of fname
+            head_rms - if head corrected, the median rms residual (mm) of the head fit to
+                the biteplate's ideal head (see ema.head_qa_dtype), None if no frame could be fitted
+            head_outliers - if head corrected, the number of frames with an outlier head sensor
+            head_space_rms, head_space_outliers - instead of head_rms and head_outliers with
+                head_space or recalibrate: the same for the fit to the recording's own head
+                template (ema.head_stabilize_data), which does not depend on the biteplate, so
+                they are not comparable with head_rms
+    '''
+    start = time.perf_counter()
+    result = {'file': fname, 'ok': False, 'error': None, 'frames': 0, 'elapsed': 0.0,
+              'skipped': False, 'input_hash': None}
+    mydir, f = os.path.split(fname)
+    try:
+        if head_space or recalibrate:
+            if recalibrate:
+                data = ema.read_head_space(mydir, f)
+                if data is None:
+                    raise ValueError("no head space data; process the recording with head_space first")
+            else:
+                data = ema.read_ndi_data(mydir, f, sensors, subcolumns, dtype=dtype)
+                if 'ideal_head' in calibration:
+                    data, qa = ema.head_stabilize_data(data, sensors, calibration['head_sensors'],
+                                                       weights=calibration.get('head_weights'),
+                                                       outlier=calibration.get('outlier'),
+                                                       return_qa=True)
+                    data.attrs.update(_head_qa_summary(qa, 'head_space'))
+                ema.save_head_space(mydir, f, data)
+            result.update({k: data.attrs[k] for k in ('head_space_rms', 'head_space_outliers')
+                           if k in data.attrs})
+            data = calibrate_head_space(data, calibration, sensors)
+            ema.save_rotated(mydir, f, data, myext)
+            result['frames'] = len(data)
+        elif 'ideal_head' in calibration:
+            data = ema.read_ndi_data(mydir, f, sensors, subcolumns, dtype=dtype)
+            data, qa = ema.head_correct_data(data, calibration['ideal_head'], sensors,
+                                             calibration['head_sensors'],
+                                             weights=calibration.get('head_weights'),
+                                             outlier=calibration.get('outlier'), return_qa=True)
+            ema.save_rotated(mydir, f, data, myext)
+            result['frames'] = len(data)
+            result.update(_head_qa_summary(qa))
+        else:
+            result['frames'] = ema.rotate_referenced_file(mydir, f, calibration['m'],
+                calibration['origin'], sensors, subcolumns, myext=myext, dtype=dtype)
+        result['input_hash'] = file_digest(fname)
+        result['ok'] = True
+    except Exception as err:   # one bad file should not stop the batch
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+    result['elapsed'] = time.perf_counter() - start
+    return result
+
+def _head_qa_summary(qa, prefix='head'):
+    '''the median rms of the head fit and the number of frames with outliers, from its qa'''
+    fitted = qa['rms'][qa['n_used'] > 0]
+    return {prefix + '_rms': float(np.median(fitted)) if len(fitted) else None,
+            prefix + '_outliers': int((qa['outliers'] > 0).sum())}
+
+def file_digest(fname):
+    '''the sha1 hex digest of the contents of a file'''
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def fingerprint(obj):
+    '''
+    a short digest that changes when obj changes; obj may be a calibration dict, or a
+    list of sensors, etc. Arrays are compared by their float64 values.
+    '''
+    def canonical(o):
+        if isinstance(o, dict):
+            return [[k, canonical(o[k])] for k in sorted(o)]
+        if isinstance(o, (list, tuple)):
+            return [canonical(v) for v in o]
+        if isinstance(o, (np.ndarray, np.generic)):
+            return np.asarray(o, dtype=np.float64).tobytes().hex()
+        return o
+    return hashlib.sha1(json.dumps(canonical(obj)).encode()).hexdigest()
+
+def read_manifest(base_directory):
+    '''the manifest of processed files in base_directory, an empty one if there is none'''
+    try:
+        with open(os.path.join(base_directory, manifest_name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'files': {}}
+
+def write_manifest(base_directory, manifest):
+    '''save the manifest, replacing the old one only once the new one is completely written'''
+    fname = os.path.join(base_directory, manifest_name)
+    with open(fname + '.part', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(fname + '.part', fname)
+
+def is_up_to_date(entry, fname, output, calibration_fp, config_fp):
+    '''
+    check a manifest entry against the current input file, output file and settings
+    
+    The input file is only read (and hashed) if its size is unchanged but its modification
+    time is not, e.g. after it was copied.  If the contents are the same, the entry's
+    modification time is brought up to date.
+    '''
+    if (entry is None or not entry['ok'] or entry['calibration'] != calibration_fp
+            or entry['config'] != config_fp or not os.path.exists(output)):
+        return False
+    st = os.stat(fname)
+    if st.st_size != entry['size']:
+        return False
+    if st.st_mtime_ns != entry['mtime_ns']:
+        if file_digest(fname) != entry['input_hash']:
+            return False
+        entry['mtime_ns'] = st.st_mtime_ns
+    return True
+
+# The settings shared by every file are sent to each worker process once, when it starts.
+_worker_config = None
+
+def _init_worker(config):
+    global _worker_config
+    _worker_config = config
+
+def _process_in_worker(fname):
+    return process_file(fname, **_worker_config)
+
+def process_directory(base_directory, sensors, subcolumns, calibration, workers=None,
+                      skip=skip_patterns, myext='ndi', progress=None, manifest=True, force=False,
+                      dtype=np.float64, planned=None, cancel=None, mp_context=None,
+                      head_space=False, recalibrate=False):
+    '''
+    process every recording in a directory, several files at a time in a pool of processes
+
+    Input
+        base_directory - the directory to search for .tsv files (see find_data_files)
+        sensors - a list of sensors in the recordings
+        subcolumns - a list of info to be found for each sensor
+        calibration - a dict made by calibrate()
+        workers - the number of processes, all cores if None; 1 processes in this process
+        progress - optional function called with each result as it is finished
+        manifest - if True, skip files whose output is up to date according to the manifest
+            in base_directory, and record each file in it as soon as it is finished, so an
+            interrupted run can be resumed
+        force - if True, process every file even if its output is up to date
+        dtype - np.float32 to process in float32, with half the memory per file
+        planned - optional function called with the number of files that will be processed,
+            once those that are up to date have been skipped
+        cancel - optional function that returns True to stop; no more files are started
+            once it does (those being processed are finished), and the results so far are
+            returned.  The manifest has every finished file, so running again carries on.
+        mp_context - the multiprocessing context of the pool, e.g. 'spawn' processes
+            when called from a program with threads (a GUI)
+        head_space - keep each recording in head space too (see process_file)
+        recalibrate - apply a new calibration to the head space data kept by an earlier
+            head_space run, e.g. after a biteplate recording was replaced; each file then costs
+            one transform of its data and the writing of its output, not a full reprocess.
+            With the manifest, only files processed with another calibration are redone.
+
+    Output
+        results - a list of result dicts (see process_file), in file name order
+    '''
+    files = find_data_files(base_directory, skip)
+    config = dict(sensors=sensors, subcolumns=subcolumns, calibration=calibration, myext=myext,
+                  dtype=dtype, head_space=head_space, recalibrate=recalibrate)
+    calibration_fp = fingerprint(calibration)
+    config_fp = fingerprint([sensors, subcolumns, myext] +
+                            ([np.dtype(dtype).name] if np.dtype(dtype) != np.float64 else []) +
+                            (['head_space'] if head_space or recalibrate else []))
+    results = []
+
+    if manifest:
+        done = read_manifest(base_directory)
+        todo = []
+        for f in files:
+            key = os.path.relpath(f, base_directory)
+            output = os.path.splitext(f)[0] + '.' + myext
+            entry = done['files'].get(key)
+            if not force and is_up_to_date(entry, f, output, calibration_fp, config_fp):
+                results.append({'file': f, 'ok': True, 'error': None, 'frames': entry['frames'],
+                                'elapsed': 0.0, 'skipped': True, 'input_hash': entry['input_hash']})
+            else:
+                todo.append(f)
+        files = todo
+    if planned:
+        planned(len(files))
+
+    def finished(r):
+        results.append(r)
+        if manifest:
+            st = os.stat(r['file'])
+            done['files'][os.path.relpath(r['file'], base_directory)] = {
+                'output': os.path.splitext(os.path.basename(r['file']))[0] + '.' + myext,
+                'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'input_hash': r['input_hash'],
+                'calibration': calibration_fp, 'config': config_fp,
+                'ok': r['ok'], 'error': r['error'], 'frames': r['frames'],
+            }
+            write_manifest(base_directory, done)
+        if progress:
+            progress(r)
+
+    if workers == 1 or len(files) < 2:
+        for f in files:
+            if cancel and cancel():
+                break
+            finished(process_file(f, **config))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(config,), mp_context=mp_context) as pool:
+            futures = [pool.submit(_process_in_worker, f) for f in files]
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                finished(future.result())
+                if cancel and cancel():
+                    for f in futures:   # the files not yet started
+                        f.cancel()
+    if manifest and not files:
+        write_manifest(base_directory, done)   # keep any refreshed modification times
+    return sorted(results, key=lambda r: r['file'])
+
+def _file_stats(fname, sensors, subcolumns, stat_sensors):
+    mydir, f = os.path.split(fname)
+    return fname, ema.ndi_stats(mydir, f, sensors, subcolumns, stat_sensors)
+
+def session_stats(base_directory, sensors, subcolumns, stat_sensors=('REF', 'RMA', 'LMA'),
+                  workers=None, skip=skip_patterns):
+    '''
+    accumulate the statistics (ema.RunningStats) of the x, y, z of some sensors over every
+    recording in a directory, each file read a chunk at a time in a pool of processes
+
+    Input
+        base_directory, sensors, subcolumns, workers, skip - as for process_directory
+        stat_sensors - the sensors to accumulate, e.g. the head sensors
+
+    Output
+        per_file - a list of (file, RunningStats), in file name order
+        session - the RunningStats of all of the files together
+    '''
+    files = find_data_files(base_directory, skip)
+    args = (sensors, subcolumns, list(stat_sensors))
+    if workers == 1 or len(files) < 2:
+        per_file = [_file_stats(f, *args) for f in files]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_file_stats, f, *args) for f in files]
+            per_file = [future.result() for future in as_completed(futures)]
+    per_file.sort(key=lambda fs: fs[0])
+    session = ema.RunningStats(['{}_{}'.format(s, c) for s in stat_sensors for c in 'xyz'])
+    for f, stats in per_file:
+        session.merge(stats)
+    return per_file, session
+
+def drift_report(per_file, session, stat_sensors=('REF', 'RMA', 'LMA')):
+    '''
+    how far the mean position of each sensor in each file is from its mean over the session
+
+    Input
+        per_file, session - from session_stats
+        stat_sensors - the sensors to report on (accumulated by session_stats)
+
+    Output
+        rows - a list of dicts, one per file: file, and for each sensor, the distance (mm)
+            of its mean in the file from its session mean ('{sensor}_drift') and the rms
+            distance of its positions in the file from their own mean ('{sensor}_sd')
+    '''
+    rows = []
+    for f, stats in per_file:
+        row = {'file': f}
+        for s in stat_sensors:
+            cols = ['{}_{}'.format(s, c) for c in 'xyz']
+            row[s + '_drift'] = float(norm(stats.mean_of(cols) - session.mean_of(cols)))
+            row[s + '_sd'] = float(np.sqrt(stats.var_of(cols).sum()))
+        rows.append(row)
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Put all of the EMA recordings in a directory '
+                                     'into the occlusal plane coordinate system.')
+    parser.add_argument('base_directory')
+    parser.add_argument('--biteplate',
+                        help='biteplate recording (or its saved .cal), relative to base_directory')
+    parser.add_argument('--sensors', nargs='+', default=sensors)
+    parser.add_argument('--bpsensors', nargs='+', help='biteplate sensors (default: --sensors)')
+    parser.add_argument('--subcolumns', nargs='+', default=subcolumns)
+    parser.add_argument('--head-correct', action='store_true',
+                        help='head correct each frame with the --head-sensors '
+                        '(for recordings made without the NDI 6D reference)')
+    parser.add_argument('--head-sensors', nargs='+', default=['REF', 'RMA', 'LMA'],
+                        help='the sensors fixed to the head, three or more (default: REF RMA LMA)')
+    parser.add_argument('--head-weights', nargs='+', type=float,
+                        help='the weight of each of the --head-sensors in the fit')
+    parser.add_argument('--outlier', type=float,
+                        help='down-weight head sensors further than this (mm) from where they '
+                        'should be (needs more than three head sensors)')
+    parser.add_argument('--workers', type=int, default=None, help='default: all cores')
+    parser.add_argument('--ext', default='ndi', help='extension of the output files')
+    parser.add_argument('--force', action='store_true',
+                        help='process all files, even those that are up to date')
+    parser.add_argument('--no-manifest', dest='manifest', action='store_false',
+                        help='do not read or write the manifest of processed files')
+    parser.add_argument('--float32', action='store_true',
+                        help='read, correct and save in float32, with half the memory (accurate to '
+                        '{} mm)'.format(ema.FLOAT32_ERROR))
+    parser.add_argument('--keep-head-space', dest='head_space', action='store_true',
+                        help='also keep each recording in head space (name.head), so that it can '
+                        'be --recalibrate\'d quickly')
+    parser.add_argument('--recalibrate', action='store_true',
+                        help='apply the --biteplate calibration to the head space data kept by an '
+                        'earlier --keep-head-space run, without reading the recordings again')
+    parser.add_argument('--drift', action='store_true',
+                        help='instead of processing, report how far the mean of each of the '
+                        '--head-sensors in each file is from its mean over all of the files')
+    parser.add_argument('--log', help='append the time and counts of each stage of each file '
+                        'to this json lines file')
+    args = parser.parse_args(argv)
+    if not args.biteplate and not args.drift:
+        parser.error('--biteplate is required')
+    if args.log:
+        ema_instrument.enable(os.path.abspath(args.log))
+
+    if args.drift:
+        per_file, session = session_stats(args.base_directory, args.sensors, args.subcolumns,
+                                          args.head_sensors, args.workers)
+        print('file\t' + '\t'.join('{0} drift (mm)\t{0} sd (mm)'.format(s) for s in args.head_sensors))
+        for row in drift_report(per_file, session, args.head_sensors):
+            print(row['file'] + ''.join('\t{:.3f}\t{:.3f}'.format(row[s + '_drift'], row[s + '_sd'])
+                                        for s in args.head_sensors))
+        return 0
+
+    calibration = calibrate(args.base_directory, args.biteplate, args.bpsensors or args.sensors,
+                            args.subcolumns, args.head_correct, args.head_sensors,
+                            args.head_weights, args.outlier)
+
+    def report(r):
+        if r['ok'] and r.get('head_rms') is not None:
+            print('{file}\t{frames} frames\t{elapsed:.2f} s\thead fit {head_rms:.3f} mm rms, '
+                  '{head_outliers} frames with outliers'.format(**r))
+        elif r['ok'] and r.get('head_space_rms') is not None:
+            print('{file}\t{frames} frames\t{elapsed:.2f} s\thead space fit {head_space_rms:.3f} '
+                  'mm rms, {head_space_outliers} frames with outliers'.format(**r))
+        elif r['ok']:
+            print('{file}\t{frames} frames\t{elapsed:.2f} s'.format(**r))
+        else:
+            print('{file}\tFAILED\t{error}'.format(**r), file=sys.stderr)
+
+    start = time.perf_counter()
+    results = process_directory(args.base_directory, args.sensors, args.subcolumns, calibration,
+                                workers=args.workers, myext=args.ext, progress=report,
+                                manifest=args.manifest, force=args.force,
+                                dtype=np.float32 if args.float32 else np.float64,
+                                head_space=args.head_space, recalibrate=args.recalibrate)
+    nok = sum(r['ok'] for r in results)
+    nskip = sum(r['skipped'] for r in results)
+    print('{} of {} files processed in {:.1f} s ({} already up to date)'.format(
+        nok - nskip, len(results) - nskip, time.perf_counter() - start, nskip))
+    return 0 if nok == len(results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
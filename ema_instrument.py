@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Optional timing and counters for the stages of the processing (parsing, masking,
+rotation, head correction, saving).
+
+Turned off, an instrumented function costs one extra test per call.  Turned on
+(enable(), or the EMA_INSTRUMENT_LOG environment variable, which batch worker
+processes inherit), each call of an instrumented stage appends one json line to the log:
+
+    {"stage": "parse", "file": "/data/s1_001.tsv", "seconds": 0.21, "rows": 2001,
+     "bytes": 3397556, "nan": 19314, "dropouts": {"REF": 0, ...}, "pid": 4242, "time": ...}
+
+Lines from different processes can share a log, and logs are appended to.  Stages nest:
+'parse' includes 'mask', and ema_batch's 'file' includes all the stages of a file.
+To see where the time went:
+
+    python ema_instrument.py session.jsonl
+"""
+import os, sys, json, time, inspect, functools
+
+log_path = os.environ.get('EMA_INSTRUMENT_LOG') or None
+
+def enable(path):
+    '''start logging stages to path (json lines, appended), in this process and its children'''
+    global log_path
+    log_path = path
+    os.environ['EMA_INSTRUMENT_LOG'] = path
+
+def disable():
+    global log_path
+    log_path = None
+    os.environ.pop('EMA_INSTRUMENT_LOG', None)
+
+def record(entry):
+    '''append one entry to the log, in a single write so that processes do not interleave'''
+    entry.setdefault('pid', os.getpid())
+    entry.setdefault('time', time.time())
+    line = json.dumps(entry, default=lambda o: o.tolist() if hasattr(o, 'tolist') else str(o)) + '\n'
+    with open(log_path, 'a') as f:
+        f.write(line)
+
+def instrumented(stage, counters=None):
+    '''
+    decorator: log the wall time of each call of a function as stage, along with the
+    counters (a dict, e.g. rows, bytes, nan, file) returned by counters(result, arguments),
+    where arguments are the function's arguments by name.
+    '''
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if log_path is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            entry = {'stage': stage, 'seconds': time.perf_counter() - start}
+            if counters is not None:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                try:
+                    entry.update(counters(result, bound.arguments))
+                except Exception as err:   # never let the bookkeeping break the processing
+                    entry['counter_error'] = repr(err)
+            record(entry)
+            return result
+        return wrapper
+    return decorate
+
+def summarize(path):
+    '''
+    add up a log by stage
+
+    Output
+        a dict: stage -> {'calls', 'seconds', 'rows', 'bytes', 'nan'}
+    '''
+    totals = {}
+    with open(path, 'r') as f:
+        for line in f:
+            entry = json.loads(line)
+            t = totals.setdefault(entry['stage'],
+                                  {'calls': 0, 'seconds': 0., 'rows': 0, 'bytes': 0, 'nan': 0})
+            t['calls'] += 1
+            for k in ('seconds', 'rows', 'bytes', 'nan'):
+                t[k] += entry.get(k) or 0
+    return totals
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    for path in argv:
+        totals = summarize(path)
+        print(path)
+        print('{:<16} {:>7} {:>10} {:>12} {:>10} {:>14} {:>10}'.format(
+            'stage', 'calls', 'seconds', 'rows', 'rows/s', 'bytes', 'nan'))
+        for stage, t in sorted(totals.items(), key=lambda kv: -kv[1]['seconds']):
+            print('{:<16} {calls:>7} {seconds:>10.3f} {rows:>12} {rate:>10.0f} {bytes:>14} {nan:>10}'.format(
+                stage, rate=t['rows'] / t['seconds'] if t['seconds'] else 0, **t))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Head correction of EMA data as it is being recorded, for live monitoring.
+
+Frames are fed to a HeadCorrectionStream one at a time (or a few at a time); each
+is fitted to the ideal head position found from the biteplate recording
+(ema.get_desired_head_location) and the corrected frame is stored in a ring buffer
+that a display can read from.  tail_ndi_file stands in for the WaveFront stream by
+following a .tsv file as it is written.
+
+    python ema_realtime.py biteplate.tsv recording.tsv --sensors ...
+
+replays recording.tsv through the stream and reports the time taken per frame.
+"""
+import os, sys, time, argparse
+import numpy as np
+import ema
+
+class HeadCorrectionStream(object):
+    '''
+    Head correct frames as they arrive and keep the most recent ones in a ring buffer.
+
+    Input
+        idealhd - (3, 3) desired locations of the head sensors (REF, RMA, LMA),
+            e.g. np.array(ema.read_3pt_biteplate(...))
+        sensors - the names of the sensors in each frame
+        head_sensors - the names of the head sensors, in the same order as idealhd
+        capacity - the number of corrected frames kept in the ring buffer
+
+    All of the memory is allocated when the stream is made, so the cost of a frame
+    does not grow as the recording goes on.  The time taken to correct each frame is
+    kept too (see timing).
+    '''
+    def __init__(self, idealhd, sensors, head_sensors=('REF', 'RMA', 'LMA'), capacity=2000):
+        self.idealhd = np.asarray(idealhd, dtype=float)
+        self.sensors = list(sensors)
+        self.head_index = [self.sensors.index(s) for s in head_sensors]
+        self.capacity = capacity
+        self.frames = np.full((capacity, len(self.sensors), 3), np.nan)
+        self.times = np.full(capacity, np.nan)
+        self.cost = np.zeros(capacity)   # seconds taken to correct each frame
+        self.count = 0                   # frames seen so far
+
+    def push(self, t, xyz):
+        '''
+        correct one frame, or a small batch of frames, and add them to the buffer
+
+        Input
+            t - the time of the frame, or a (n,) array of times
+            xyz - (sensors, 3) sensor locations, or (n, sensors, 3) for a batch of frames;
+                nan for sensors that are not OK
+
+        Output
+            the corrected frame(s), (sensors, 3) or (n, sensors, 3): a new array, not a view
+            into the ring buffer, so it is not changed by later calls to push
+        '''
+        start = time.perf_counter()
+        xyz = np.asarray(xyz, dtype=float)
+        single = xyz.ndim == 2
+        if single:
+            xyz = xyz[np.newaxis]
+        n = len(xyz)
+        if n > self.capacity:
+            raise ValueError("more frames than the ring buffer can hold")
+
+        rotated, _, _ = ema.head_correct_and_rotate(xyz[:, self.head_index], self.idealhd, xyz)
+
+        # frames go into consecutive slots, wrapping around at the end of the buffer
+        slots = (self.count + np.arange(n)) % self.capacity
+        self.frames[slots] = rotated
+        self.times[slots] = t
+        self.cost[slots] = (time.perf_counter() - start) / n
+        self.count += n
+        return rotated[0] if single else rotated
+
+    def latest(self, n=None):
+        '''
+        return copies of the last n corrected frames (all those in the buffer if n is None),
+        oldest first, as times (n,) and frames (n, sensors, 3)
+        '''
+        have = min(self.count, self.capacity)
+        n = have if n is None else min(n, have)
+        slots = (self.count - n + np.arange(n)) % self.capacity
+        return self.times[slots], self.frames[slots]
+
+    def timing(self):
+        '''the mean, 99th percentile and maximum time per frame (ms) over the buffered frames'''
+        cost = self.cost[:min(self.count, self.capacity)] * 1000
+        if len(cost) == 0:
+            return {'mean': np.nan, 'p99': np.nan, 'max': np.nan}
+        return {'mean': cost.mean(), 'p99': np.percentile(cost, 99), 'max': cost.max()}
+
+def tail_ndi_file(fname, sensors, subcolumns, poll=0.002, timeout=1.0):
+    '''
+    follow an NDI WaveFront .tsv file as it is written, like tail -f
+
+    Input
+        fname - path of the .tsv file
+        sensors - a list of sensors in the recording
+        subcolumns - a list of info to be found for each sensor, including state, x, y and z
+        poll - seconds to wait before looking for more data
+        timeout - stop when no new data has been written for this many seconds
+
+    Output
+        yields (time, xyz) for each frame, where xyz is a (sensors, 3) array with nan
+        for sensors that are not OK
+    '''
+    columns = ema.ndi_column_names(fname, sensors, subcolumns)
+    time_idx = columns.index('time')
+    state_idx = [columns.index('{}_state'.format(s)) for s in sensors]
+    xyz_idx = [columns.index('{}_{}'.format(s, c)) for s in sensors for c in 'xyz']
+
+    with open(fname, 'r') as f:
+        f.readline()   # the header
+        partial = ''
+        waited = 0.0
+        while True:
+            line = f.readline()
+            if not line.endswith('\n'):   # at the end of what has been written so far
+                partial += line
+                if waited >= timeout:
+                    return
+                time.sleep(poll)
+                waited += poll
+                continue
+            line, partial, waited = partial + line, '', 0.0
+            fields = line.rstrip('\n').split('\t')
+            # unplugged channels have empty fields, and missing tools the NDI sentinel:
+            # both are masked by their state, as in ema.mask_bad_states
+            xyz = np.array([fields[i] or 'nan' for i in xyz_idx], dtype=float).reshape(len(sensors), 3)
+            xyz[[fields[i] != 'OK' for i in state_idx]] = np.nan
+            yield float(fields[time_idx]), xyz
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a recording through the real-time '
+                                     'head correction and report the time taken per frame.')
+    parser.add_argument('biteplate')
+    parser.add_argument('recording')
+    parser.add_argument('--sensors', nargs='+', required=True)
+    parser.add_argument('--subcolumns', nargs='+',
+                        default=["ID","frame","state","q0","qx","qy","qz","x","y","z"])
+    args = parser.parse_args(argv)
+
+    bpdir, bpname = os.path.split(args.biteplate)
+    idealhd = np.array(ema.read_3pt_biteplate(bpdir, bpname, args.sensors, args.subcolumns))
+    stream = HeadCorrectionStream(idealhd, args.sensors)
+    for t, xyz in tail_ndi_file(args.recording, args.sensors, args.subcolumns, timeout=0):
+        stream.push(t, xyz)
+
+    cost = stream.timing()
+    print('{} frames, per frame: mean {:.3f} ms, 99% {:.3f} ms, max {:.3f} ms '
+          '(a frame every 5 ms at 200 Hz)'.format(stream.count, cost['mean'], cost['p99'], cost['max']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+All of the recordings of a session (a directory), indexed by subject, acquisition type
+and trial from their file names, e.g. knight_no_ref_000.tsv, knight_occlusal_001.wav.
+
+    session = Session('data/', sensormap)
+    session.files                          # one row per .tsv/.wav/.wco file
+    tt = session.tvals('tongueTip', acqtype='no_ref', start=0.5, end=1.0)
+    tt[('knight', 'no_ref', '000')]        # (frames, 1, 3) array
+
+Recordings are only read when they are asked for, and only the columns of the sensors
+that are asked for (ema.read_ndi_data(keep=...), through the parse cache, so reading
+them again does not parse the .tsv file again).  The most recently used (max_open) are
+kept in memory, so a query over every trial of a subject holds the requested sensors of
+one recording at a time plus the (small) windows that were asked for.
+"""
+import os, re
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import ema, ema_audio
+
+# the columns of each channel in the .tsv files, and those with the Q0...Tz values
+subcolumns = ["ID", "frame", "state", "q0", "qx", "qy", "qz", "x", "y", "z"]
+qt_subcolumns = ['q0', 'qx', 'qy', 'qz', 'x', 'y', 'z']
+
+# Filenaming like:
+# knight_occlusal_001.wav, knight_no_ref_000.tsv, knight_palate_002.wco
+acqpat = re.compile(
+    r'''
+    ^                      # filename starts with...
+    (?P<sname>[^_]+)       # subject name (series of non-underscore chars)
+    _                      # underscore
+    (?P<acqtype>.+)        # acquisition type (series of chars, including underscore)
+    _                      # underscore
+    (?P<trial>\d+)         # left-padded integer trial number
+    \.(tsv|wav|wco)        # file extension
+    $                      # ...and no more
+    ''',
+    re.VERBOSE
+)
+
+def index_files(datadir, pattern=acqpat):
+    '''
+    find the acquisition files in a directory (and its subdirectories)
+
+    Input
+        datadir - the directory to search
+        pattern - a regular expression with groups sname, acqtype and trial that
+            matches the file names to include
+
+    Output
+        files - a dataframe with one row per file, and columns dirname, fname, barename,
+            ext, bytes, sname, acqtype, trial (the trial number as in the file name)
+    '''
+    rows = []
+    for root, dirs, fnames in os.walk(datadir):
+        for f in sorted(fnames):
+            m = pattern.match(f)
+            if m is None:
+                continue
+            barename, ext = os.path.splitext(f)
+            rows.append(dict(dirname=root, fname=f, barename=barename, ext=ext,
+                             bytes=os.path.getsize(os.path.join(root, f)),
+                             sname=m.group('sname'), acqtype=m.group('acqtype'),
+                             trial=m.group('trial')))
+    columns = ['dirname', 'fname', 'barename', 'ext', 'bytes', 'sname', 'acqtype', 'trial']
+    return pd.DataFrame(rows, columns=columns).sort_values(
+        ['sname', 'acqtype', 'trial', 'ext']).reset_index(drop=True)
+
+class Session(object):
+    '''
+    The recordings in a directory, whose sensors are read when they are used.
+
+    Input
+        datadir - the directory of the session
+        sensormap - {'sensor_name': channel index, ...} (see ema.NDIData)
+        pattern - the file name pattern (see index_files)
+        max_open - the number of (recording, sensors) reads to keep in memory
+        subcolumns - the columns of each channel in the .tsv files (see ema.read_ndi_data)
+        read_args - other arguments for ema.read_ndi_data, e.g. dtype, cache
+
+    The directory is only searched once, when the session is made; call reindex
+    if files are added.
+    '''
+    def __init__(self, datadir, sensormap, pattern=acqpat, max_open=4, subcolumns=subcolumns,
+                 **read_args):
+        self.datadir = datadir
+        self.sensormap = sensormap
+        self.pattern = pattern
+        self.max_open = max_open
+        self.subcolumns = list(subcolumns)
+        self.read_args = read_args
+        # (key, sensors) -> (time, qt), least recently used first
+        self._open = OrderedDict()
+        self.reindex()
+
+    def reindex(self):
+        self.files = index_files(self.datadir, self.pattern)
+        self._open.clear()
+
+    def trials(self, sname=None, acqtype=None, trial=None, ext='.tsv'):
+        '''
+        the (sname, acqtype, trial) keys of the recordings that match; each of sname,
+        acqtype and trial may be a value, a list of values or None for all.
+        Trials may be given as numbers.
+        '''
+        f = self.files[self.files.ext == ext]
+        for col, want in (('sname', sname), ('acqtype', acqtype), ('trial', trial)):
+            if want is None:
+                continue
+            want = [want] if isinstance(want, (str, int)) else list(want)
+            if col == 'trial':
+                f = f[f.trial.astype(int).isin([int(w) for w in want])]
+            else:
+                f = f[f[col].isin(want)]
+        return list(zip(f.sname, f.acqtype, f.trial))
+
+    def path(self, key, ext='.tsv'):
+        '''the path of the ext file of a recording'''
+        sname, acqtype, trial = key
+        f = self.files
+        row = f[(f.sname == sname) & (f.acqtype == acqtype) & (f.trial == trial) & (f.ext == ext)]
+        if len(row) == 0:
+            raise KeyError("no {} file for {}".format(ext, '_'.join(key)))
+        return os.path.join(row.dirname.iloc[0], row.fname.iloc[0])
+
+    def recording(self, key):
+        '''the whole of a recording as an NDIData (all of its columns are parsed)'''
+        return ema.NDIData(self.path(key), self.sensormap,
+                           dtype=self.read_args.get('dtype', np.float64))
+
+    def channels(self, fname):
+        '''the names to give the channels of a .tsv file: the sensormap's, or 'ch{n}' '''
+        with open(fname, 'r') as f:
+            nchannels = sum(h.startswith('Q0') for h in f.readline().rstrip('\n').split('\t'))
+        names = {i: s for s, i in self.sensormap.items()}
+        return [names.get(i, 'ch{}'.format(i)) for i in range(nchannels)]
+
+    def _load(self, key, sensors):
+        '''
+        the time and the (frames, sensors, 7) Q0...Tz values of some sensors of a recording,
+        read now (only their columns) if they are not already open
+        '''
+        if sensors is None:
+            sensors = sorted(self.sensormap, key=self.sensormap.get)
+        elif isinstance(sensors, str):
+            sensors = [sensors]
+        okey = (key, tuple(sensors))
+        if okey in self._open:
+            self._open.move_to_end(okey)
+            return self._open[okey]
+        fname = self.path(key)
+        qt = [c for q in qt_subcolumns for c in self.subcolumns if c.lower() == q]
+        state = [c for c in self.subcolumns if c.lower() == 'state']
+        df = ema.read_ndi_data(os.path.dirname(fname), os.path.basename(fname), self.channels(fname),
+                               self.subcolumns, fields=state + qt, keep=sensors, **self.read_args)
+        vals = df.loc[:, ['{}_{}'.format(s, c) for s in sensors for c in qt]].to_numpy()
+        loaded = (df['time'].to_numpy(dtype=np.float64), vals.reshape(len(df), len(sensors), len(qt)))
+        self._open[okey] = loaded
+        while len(self._open) > self.max_open:
+            self._open.popitem(last=False)
+        return loaded
+
+    def acquisition(self, key):
+        '''the ema_audio.Acquisition of a recording, for time-aligned audio and EMA slices'''
+        base = os.path.splitext(self.path(key, '.wco'))[0]
+        return ema_audio.Acquisition(base, self.sensormap)
+
+    def iter_vals(self, qt, sensors=None, start=None, end=None, **query):
+        '''
+        yields (key, values) for each recording that matches the query (see trials);
+        values are the qt ('QT', 'Q' or 'T') values of sensors (None for all of the
+        sensors in the sensormap) between start and end (see ema.NDIData.qtvals), copied so that they do not keep the recording in memory
+        '''
+        fields = {'QT': slice(0, 7), 'Q': slice(0, 4), 'T': slice(4, 7)}[qt]
+        for key in self.trials(**query):
+            time, vals = self._load(key, sensors)
+            lo = 0 if start is None else int(np.searchsorted(time, start, side='left'))
+            hi = len(time) if end is None else int(np.searchsorted(time, end, side='right'))
+            yield key, np.array(vals[lo:max(lo, hi), :, fields])
+
+    def tvals(self, sensors=None, start=None, end=None, **query):
+        '''a dict of (sname, acqtype, trial) -> the Tx, Ty, Tz values of sensors (see iter_vals)'''
+        return dict(self.iter_vals('T', sensors, start, end, **query))
+
+    def qvals(self, sensors=None, start=None, end=None, **query):
+        '''a dict of (sname, acqtype, trial) -> the Q0, Qx, Qy, Qz values of sensors'''
+        return dict(self.iter_vals('Q', sensors, start, end, **query))
+
+    def qtvals(self, sensors=None, start=None, end=None, **query):
+        '''a dict of (sname, acqtype, trial) -> the Q0...Tz values of sensors'''
+        return dict(self.iter_vals('QT', sensors, start, end, **query))
@@ -8,16 +8,64 @@ Created on Sat Jun 17 14:25:38 2017
 """
 from PyQt5.QtWidgets import (QMainWindow, QGroupBox,QApplication, QLineEdit, 
                              QAction, QComboBox, QLabel, QHBoxLayout,
-                             QFileDialog, QPushButton, QDialog, QVBoxLayout)
+                             QFileDialog, QPushButton, QDialog, QVBoxLayout,
+                             QProgressBar)
 from PyQt5.QtGui import QDoubleValidator
+from PyQt5.QtCore import (QSettings, QTimer, QObject, QRunnable, QThreadPool,
+                          pyqtSignal)
 
 import numpy as np
-import os, sys, re
+import os, sys, time, threading, multiprocessing
 from itertools import cycle
-import ema
+import ema, ema_batch
+# matplotlib is imported when the first Window is opened (it is slow to import, and the
+# batch worker processes, which import this module, never draw)
+
+class TaskSignals(QObject):
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    progress = pyqtSignal(object)
+
+class Task(QRunnable):
+    '''
+    run fn(*args, **kwargs) on a thread of a QThreadPool, so that the window keeps
+    responding.  The result (done), an error message (failed) and anything passed to
+    report (progress) arrive in the GUI thread as signals.
+    '''
+    def __init__(self, fn, *args, **kwargs):
+        super().__init__()
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+        self.signals = TaskSignals()
+
+    def report(self, item):
+        self.signals.progress.emit(item)
 
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
+    def run(self):
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except Exception as err:
+            self.signals.failed.emit(str(err) or type(err).__name__)
+        else:
+            self.signals.done.emit(result)
+
+def load_palate(mydir, palname, sensors, subcolumns, calibration):
+    '''read, rotate and save a palate trace; returns the data and a status message'''
+    pdata = ema.read_ndi_data(mydir, palname, sensors, subcolumns)
+    message = 'Palate trace: success'
+    if calibration is None:
+        message = 'No rotation applied'
+    else:
+        pdata = ema.rotate_referenced_data(pdata, calibration.m, calibration.origin, sensors)
+    ema.save_rotated(mydir, palname, pdata)
+    return pdata, message
+
+def load_trial(mydir, fname, sensors, subcolumns, calibration):
+    '''read and rotate a recording for display; returns the data and a status message'''
+    data = ema.read_ndi_data(mydir, fname, sensors, subcolumns)
+    if calibration is None:
+        return data, 'No rotation applied'
+    data = ema.rotate_referenced_data(data, calibration.m, calibration.origin, sensors)
+    return data, 'Showing rotated data'
 
 class Main(QMainWindow):
     
@@ -35,9 +83,17 @@ class Main(QMainWindow):
         self.subcolumns = ["ID","frame","state","q0","qx","qy","qz","x","y","z"]
         self.pal_start = 0
         self.pal_end = 15
+        self.calibration = None
         self.setGeometry(100,100,300,600)
+
+        # reading, calibrating, rotating and saving run on these threads (see Task)
+        self.pool = QThreadPool.globalInstance()
+        self.tasks = set()    # the running tasks, so that their signals are not collected
+        self.batch = None     # the cancel event of the running batch
+        self.batch_task = None
  
         self.initUI()
+        self.restore_biteplate()
         
         
     def initUI(self):               
@@ -50,6 +106,15 @@ class Main(QMainWindow):
         
         menubar = self.menuBar()
         self.statusBar().showMessage('Ready')
+
+        # batch progress: files done / files to do, and a button to stop starting new ones
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.cancel_button = QPushButton('Cancel', self)
+        self.cancel_button.clicked.connect(self.cancel_batch)
+        self.cancel_button.hide()
+        self.statusBar().addPermanentWidget(self.cancel_button)
         
         # -------- this section makes the menu bar --------------------
         exitAct = QAction('&Exit', self)        
@@ -242,14 +307,48 @@ class Main(QMainWindow):
         self.base_button.setText(self.base_directory)
         self.BPbutton.setText(self.bpname)
         
-        try:
-            self.origin, self.m = ema.read_biteplate(
-                    self.base_directory,self.bpname,
-                    self.bpsensors, self.subcolumns)
-            self.statusBar().showMessage('origin: {}'.format(self.origin))
-        except ValueError as err:
-            self.statusBar().showMessage(err.args[0])
-            
+        self.read_biteplate()
+
+    def run_task(self, message, done, fn, *args, **kwargs):
+        '''start fn(*args, **kwargs) on the thread pool; done(result) is called when it returns'''
+        task = Task(fn, *args, **kwargs)
+        self.tasks.add(task)
+        task.signals.done.connect(done)
+        task.signals.failed.connect(self.statusBar().showMessage)
+        for signal in (task.signals.done, task.signals.failed):
+            signal.connect(lambda result, task=task: self.tasks.discard(task))
+        self.statusBar().showMessage(message)
+        self.pool.start(task)
+        return task
+
+    def read_biteplate(self):
+        bpfile = os.path.join(self.base_directory, self.bpname)
+        bpsensors = list(self.bpsensors)
+        self.run_task('reading {} ...'.format(self.bpname),
+                      lambda calibration: self.biteplate_read(calibration, bpfile, bpsensors),
+                      ema.biteplate_calibration, self.base_directory, self.bpname,
+                      bpsensors, list(self.subcolumns))
+
+    def biteplate_read(self, calibration, bpfile, bpsensors):
+        self.calibration = calibration
+        self.origin, self.m = calibration.origin, calibration.m
+        self.statusBar().showMessage('origin: {}'.format(self.origin))
+        # remember the biteplate, so the next session starts with the same calibration
+        settings = QSettings('ema_head_correction', 'Process EMA')
+        settings.setValue('biteplate', bpfile)
+        settings.setValue('bpsensors', ' '.join(bpsensors))
+
+    def restore_biteplate(self):
+        settings = QSettings('ema_head_correction', 'Process EMA')
+        last = settings.value('biteplate')
+        if not last or not os.path.exists(last):
+            return
+        self.base_directory,self.bpname = os.path.split(last)
+        self.bpsensors = settings.value('bpsensors', ' '.join(self.bpsensors)).split(' ')
+        self.base_button.setText(self.base_directory)
+        self.BPbutton.setText(self.bpname)
+        self.bp_edit.setText(' '.join(self.bpsensors))
+        self.read_biteplate()   # quick: loads the .cal saved with the biteplate recording
 
     def PL_FileDialog(self):
         fname, wcard = QFileDialog.getOpenFileName(self, 'Open Palate file', self.base_directory,
@@ -258,20 +357,14 @@ class Main(QMainWindow):
         self.base_button.setText(self.base_directory)
         self.PLbutton.setText(self.palname)
         
-        try:
-            self.pdata = ema.read_ndi_data(self.base_directory,self.palname,
-                                self.PAL_sensors,self.subcolumns)
-            self.statusBar().showMessage('Palate trace: success')
-        except ValueError as err:
-            self.statusBar().showMessage(err.args[0])
-            
-        try:
-            self.pdata = ema.rotate_data(self.pdata,self.m,self.origin,self.PAL_sensors)
-        except:
-            self.statusBar().showMessage('No rotation applied')
+        self.run_task('reading {} ...'.format(self.palname), self.palate_read,
+                      load_palate, self.base_directory, self.palname,
+                      list(self.PAL_sensors), list(self.subcolumns), self.calibration)
 
+    def palate_read(self, result):
+        self.pdata, message = result
         self.tracetimes = (self.pdata.time > self.pal_start) & (self.pdata.time < self.pal_end)
-        ema.save_rotated(self.base_directory,self.palname,self.pdata)
+        self.statusBar().showMessage(message)
 
         
     def base_FileDialog(self):
@@ -284,63 +377,139 @@ class Main(QMainWindow):
         	'TSV Files (*.tsv);;All Files (*)')
         self.base_directory,onename = os.path.split(fname)
 
-        try:
-            self.data = ema.read_ndi_data(self.base_directory,onename,self.sensors,self.subcolumns)
-        except ValueError as err:
-            self.statusBar().showMessage(err.args[0])
-            return
-
-        try:
-            self.data = ema.rotate_data(self.data,self.m,self.origin,self.sensors)
-            self.statusBar().showMessage('Showing rotated data')
+        # the window opens when the (possibly long) trial has been read and rotated
+        self.run_task('reading {} ...'.format(onename), self.trial_read,
+                      load_trial, self.base_directory, onename,
+                      list(self.sensors), list(self.subcolumns), self.calibration)
 
-        except:
-            self.statusBar().showMessage('No rotation applied')
-
-        
+    def trial_read(self, result):
+        self.data, message = result
+        self.statusBar().showMessage(message)
         win = Window(self)
         win.move(0,0)
         win.show()
     
     def process_lots_of_files(self):
-#def rotate_all(base_directory,sensors, subcolumns, origin, m):
-    # loop over tsv files, read them, rotate them, save the old as file.raw
-    # save the rotated as file.tsv 
-
-        for root, dirs,files in os.walk(self.base_directory):
-            for f in files: 
-                base,ext = os.path.splitext(f)
-                if ext != '.tsv':
-                    continue
-                if re.match("\w+BitePlate.*",f):
-                    continue
-                if re.match("\w+Palate.*",f):
-                    continue
-                try:
-                    data = ema.read_ndi_data(self.base_directory, f, self.sensors,self.subcolumns)
-                except ValueError as err:
-                    self.statusBar().showMessage(err.args[0])
-
-                try:
-                    data=ema.rotate_data(data,self.m,self.origin,self.sensors)
-                    ema.save_rotated(self.base_directory,f,data)
-                    self.statusBar().showMessage('Processed {}'.format(f))
-                except:
-                    self.statusBar().showMessage('rotation not applied')
-        # file dialog with wild card to specify files to be processed
-        #  - or simply walk the base directory and process all nonBP and nonPAL files?
+    # loop over the non-biteplate, non-palate tsv files in the base directory, read them,
+    # rotate them and save the rotated data as file.ndi (see ema_batch), in worker
+    # processes, reporting each file as it finishes
+        if self.calibration is None:
+            self.statusBar().showMessage('read a Biteplate file first')
+            return
+        if self.batch is not None:
+            self.statusBar().showMessage('a batch is already running')
+            return
+        calibration = {'origin': self.origin, 'm': self.m}
+
+        self.batch = threading.Event()
+        self.batch_total, self.batch_done, self.batch_frames = 0, 0, 0
+        self.batch_failed = []
+        self.batch_start = time.perf_counter()
+        self.progress_bar.setRange(0, 0)   # busy, until the number of files is known
+        self.progress_bar.show()
+        self.cancel_button.setEnabled(True)
+        self.cancel_button.show()
+
+        # spawned, not forked, workers: this process has Qt's threads
+        task = Task(ema_batch.process_directory, self.base_directory, list(self.sensors),
+                    list(self.subcolumns), calibration, cancel=self.batch.is_set,
+                    mp_context=multiprocessing.get_context('spawn'))
+        task.kwargs.update(planned=task.report, progress=task.report)
+        task.signals.progress.connect(self.batch_progress)
+        task.signals.done.connect(self.batch_finished)
+        task.signals.failed.connect(lambda message: self.batch_finished(None, message))
+        self.batch_task = task
+        self.statusBar().showMessage('looking for files to process ...')
+        self.pool.start(task)
+
+    def batch_progress(self, item):
+        if isinstance(item, int):   # the number of files to process
+            self.batch_total = item
+            self.progress_bar.setRange(0, max(item, 1))
+            self.progress_bar.setValue(0)
+            return
+        self.batch_done += 1
+        self.batch_frames += item['frames']
+        if not item['ok']:
+            self.batch_failed.append(item)
+        self.progress_bar.setValue(self.batch_done)
+        elapsed = time.perf_counter() - self.batch_start
+        self.statusBar().showMessage('{} ({}/{}), {:.1f} files/s, {:.0f} frames/s'.format(
+            os.path.basename(item['file']), self.batch_done, self.batch_total,
+            self.batch_done / elapsed, self.batch_frames / elapsed))
+
+    def cancel_batch(self):
+        if self.batch is not None:
+            self.batch.set()
+            self.cancel_button.setEnabled(False)
+            self.statusBar().showMessage('cancelling: finishing the files in progress ...')
+
+    def batch_finished(self, results, error=None):
+        cancelled = self.batch.is_set()
+        self.batch, self.batch_task = None, None
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        if error is not None:
+            self.statusBar().showMessage(error)
+            return
+        skipped = sum(r['skipped'] for r in results)
+        self.statusBar().showMessage('Processed {} files, {} failed, {} up to date{}'.format(
+            self.batch_done - len(self.batch_failed), len(self.batch_failed), skipped,
+            ' (cancelled)' if cancelled else ''))
+
+    def closeEvent(self, event):
+        self.cancel_batch()   # don't start any more files after the window is closed
+        super().closeEvent(event)
+
+def decimate_to_pixels(x, y, xlim, ylim, width, height):
+    '''
+    thin a cloud of points to what can be seen: one point per occupied screen pixel
+    
+    Input
+        x, y - arrays of point coordinates (nan points are dropped)
+        xlim, ylim - the (min, max) data limits of the axes
+        width, height - the size of the axes in pixels
+        
+    Output
+        x, y - the first point that falls in each pixel inside the limits.  Drawn with
+            the pixel marker (','), this looks the same as drawing every point.
+    '''
+    x0, x1 = sorted(xlim)
+    y0, y1 = sorted(ylim)
+    keep = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)   # also drops nan
+    x, y = x[keep], y[keep]
+    width, height = max(int(width), 1), max(int(height), 1)
+    ix = np.minimum(((x - x0) / ((x1 - x0) or 1) * width).astype(np.int64), width - 1)
+    iy = np.minimum(((y - y0) / ((y1 - y0) or 1) * height).astype(np.int64), height - 1)
+    _, first = np.unique(ix * height + iy, return_index=True)
+    first.sort()   # keep the points in time order
+    return x[first], y[first]
 
 class Window(QDialog):
+    '''
+    side and front views of the sensor trajectories (and the palate trace).
+    
+    Only what can be seen at screen resolution is handed to matplotlib (decimate_to_pixels),
+    so a long recording opens quickly.  When the view is zoomed or panned (toolbar) or the
+    window is resized, the same lines are refilled (set_data) with the detail that is now visible.
+    '''
     def __init__(self, parent=None):
         super(Window, self).__init__(parent)
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+        from matplotlib.figure import Figure
 
         self.figure = Figure()
         self.canvas = FigureCanvas(self.figure)
         layout = QVBoxLayout()
+        layout.addWidget(NavigationToolbar(self.canvas, self))
         layout.addWidget(self.canvas)
         self.setLayout(layout)
         
+        self.traces = []     # (axes, line, x, y): every point, and the line that shows some of them
+        self.refining = False
         self.plot(parent)
+        self.canvas.mpl_connect('resize_event', lambda event: self.schedule_refine())
 
         
     def plot(self, parent):
@@ -368,23 +537,57 @@ class Window(QDialog):
             sym = next(psym)
             
             #   and plot the data
-            ax1.plot(data.loc[:,locx],data.loc[:,locy],sym)
-            ax2.plot(data.loc[:,locz],data.loc[:,locy],sym)
+            self.add_trace(ax1, data.loc[:,locx], data.loc[:,locy], sym)
+            self.add_trace(ax2, data.loc[:,locz], data.loc[:,locy], sym)
       
         try:
             pdata = parent.pdata
             tracetimes = parent.tracetimes
-            ax1.plot(pdata[tracetimes].PL_x,pdata[tracetimes].PL_y,"g,")
-            ax2.plot(pdata[tracetimes].PL_z,pdata[tracetimes].PL_y,"g,")
+            self.add_trace(ax1, pdata[tracetimes].PL_x, pdata[tracetimes].PL_y, "g,")
+            self.add_trace(ax2, pdata[tracetimes].PL_z, pdata[tracetimes].PL_y, "g,")
         except:
             pass
         
-
-        self.canvas.draw()
-        
-np.seterr(all='raise')
+        for ax in (ax1, ax2):
+            self.fit_limits(ax)
+            ax.callbacks.connect('xlim_changed', lambda ax: self.schedule_refine())
+            ax.callbacks.connect('ylim_changed', lambda ax: self.schedule_refine())
+        self.refine()
+
+    def add_trace(self, ax, x, y, sym):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        line, = ax.plot([], [], sym)
+        self.traces.append((ax, line, x, y))
+
+    def fit_limits(self, ax):
+        '''set the limits to all of the points, as autoscaling would if they were all plotted'''
+        xs = np.concatenate([x for a, line, x, y in self.traces if a is ax])
+        ys = np.concatenate([y for a, line, x, y in self.traces if a is ax])
+        good = np.isfinite(xs) & np.isfinite(ys)
+        if not good.any():
+            return
+        for vals, setlim in ((xs[good], ax.set_xlim), (ys[good], ax.set_ylim)):
+            lo, hi = vals.min(), vals.max()
+            pad = 0.05 * (hi - lo) or 1.
+            setlim(lo - pad, hi + pad)
+
+    def schedule_refine(self):
+        '''refine once, after a zoom has changed both of the limits'''
+        if not self.refining:
+            self.refining = True
+            QTimer.singleShot(0, self.refine)
+
+    def refine(self):
+        self.refining = False
+        for ax, line, x, y in self.traces:
+            bbox = ax.get_window_extent()
+            line.set_data(*decimate_to_pixels(x, y, ax.get_xlim(), ax.get_ylim(),
+                                              bbox.width, bbox.height))
+        self.canvas.draw_idle()
 
 if __name__ == '__main__':
+    np.seterr(all='raise')   # in the GUI only, not in the batch workers that import this module
     
     app = QApplication(sys.argv)
     ex = Main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Write synthetic recordings in the NDI WaveFront .tsv format, for testing and benchmarks.
+
+    python synth_ndi.py out.tsv --duration 60 --channels 16 --dropout 0.01
+
+The files have the layout that ema.read_ndi_data expects: a 'Wav Time' column, then
+for each channel the tool ID, Frame, State, Q0, Qx, Qy, Qz, Tx, Ty, Tz columns, with an
+empty ' ' column after every 8 channels.  Frames where a tool drops out have a State
+other than OK and the NDI sentinel value in every numeric field.  Channels with no
+sensor plugged in (unplugged) have all of their columns empty, as WaveFront writes them.
+
+The head (REF, RMA, LMA, and the OS and MS biteplate sensors, which are fixed to it)
+moves slowly as a rigid body, and the articulator sensors move about in the head.
+"""
+import sys, argparse
+import numpy as np
+
+# in channel order; the first five are fixed to the head
+sensors = ["REF","RMA","LMA","OS","MS","UL","LL","JW","TT","TB","TD","TL","LC","UI","J","PL"]
+subcolumns = ["ID","frame","state","q0","qx","qy","qz","x","y","z"]
+SENTINEL = '-3.697314E28'
+
+# where the head sensors are in the head (mm)
+head_positions = {
+    'REF': [10., 90., 0.], 'RMA': [-80., 20., -70.], 'LMA': [-80., 20., 70.],
+    'OS': [0., 0., 0.], 'MS': [-40., 0., 0.],
+}
+
+def _rotations(angles):
+    '''(frames, 3, 3) rotation matrices from (frames, 3) small x, y, z rotations (radians)'''
+    cx, cy, cz = np.cos(angles).T
+    sx, sy, sz = np.sin(angles).T
+    one, zero = np.ones_like(cx), np.zeros_like(cx)
+    rx = np.stack([one, zero, zero, zero, cx, -sx, zero, sx, cx], 1).reshape(-1, 3, 3)
+    ry = np.stack([cy, zero, sy, zero, one, zero, -sy, zero, cy], 1).reshape(-1, 3, 3)
+    rz = np.stack([cz, -sz, zero, sz, cz, zero, zero, zero, one], 1).reshape(-1, 3, 3)
+    return rz @ ry @ rx
+
+def _quaternions(R):
+    '''(frames, 4) w, x, y, z quaternions of (frames, 3, 3) rotation matrices (w > 0)'''
+    w = np.sqrt(np.maximum(1 + R[:, 0, 0] + R[:, 1, 1] + R[:, 2, 2], 1e-12)) / 2
+    x = (R[:, 2, 1] - R[:, 1, 2]) / (4 * w)
+    y = (R[:, 0, 2] - R[:, 2, 0]) / (4 * w)
+    z = (R[:, 1, 0] - R[:, 0, 1]) / (4 * w)
+    return np.stack([w, x, y, z], 1)
+
+def synthesize(nchannels=16, duration=10., fs=200, dropout=0.01, seed=0):
+    '''
+    make the values of a synthetic recording
+
+    Input
+        nchannels - the number of channels (sensors), at most len(synth_ndi.sensors)
+        duration - seconds
+        fs - frames per second
+        dropout - the fraction of sensor frames that are missing (in runs of 1-10 frames)
+        seed - random seed
+
+    Output
+        time - (frames,) times
+        xyz - (frames, channels, 3) positions
+        q - (frames, channels, 4) orientations
+        ok - (frames, channels) False where the tool dropped out
+        names - the sensor names of the channels
+    '''
+    rng = np.random.default_rng(seed)
+    names = sensors[:nchannels]
+    nframes = int(round(duration * fs))
+    t = (np.arange(nframes) + 1) / fs
+
+    # slow head movement: a few degrees of rotation and a few mm of translation
+    slow = lambda scale: scale * np.sin(2 * np.pi * t[:, np.newaxis] * rng.uniform(0.05, 0.3, 3)
+                                        + rng.uniform(0, 2 * np.pi, 3))
+    R = _rotations(slow(np.radians(3)))
+    T = slow(5.) + [0., 50., -300.]
+
+    # articulators move around their rest positions at speech rates
+    local = np.empty((nframes, len(names), 3))
+    for i, s in enumerate(names):
+        if s in head_positions:
+            local[:, i] = head_positions[s]
+        else:
+            rest = rng.uniform([-60, -30, -20], [20, 10, 20])
+            local[:, i] = rest + 8 * np.sin(2 * np.pi * t[:, np.newaxis] * rng.uniform(1, 6, 3)
+                                            + rng.uniform(0, 2 * np.pi, 3))
+    xyz = np.einsum('fij,fsj->fsi', R, local) + T[:, np.newaxis, :]
+    xyz += rng.normal(scale=0.05, size=xyz.shape)
+    q = np.repeat(_quaternions(R)[:, np.newaxis, :], len(names), axis=1)
+
+    # dropouts come in short runs
+    ok = np.ones((nframes, len(names)), dtype=bool)
+    nruns = int(dropout * ok.size / 5.5)
+    for start, ch, length in zip(rng.integers(0, nframes, nruns), rng.integers(0, len(names), nruns),
+                                 rng.integers(1, 11, nruns)):
+        ok[start:start + length, ch] = False
+    return t, xyz, q, ok, names
+
+def write_recording(fname, nchannels=16, duration=10., fs=200, dropout=0.01, seed=0, unplugged=()):
+    '''
+    write a synthetic recording (see synthesize) as an NDI WaveFront .tsv file;
+    the channels (indexes) in unplugged are written with empty columns
+
+    Output
+        names - the sensor names of the channels, to pass to ema.read_ndi_data
+    '''
+    t, xyz, q, ok, names = synthesize(nchannels, duration, fs, dropout, seed)
+    nframes = len(t)
+    fmt = lambda vals, f: np.char.mod(f, vals)
+
+    header = ['Wav Time']
+    columns = [fmt(t, '%.6f')]
+    frame = fmt(np.arange(nframes) + 100000, '%d')
+    for i in range(len(names)):
+        if i and i % 8 == 0:
+            header.append(' ')
+            columns.append(np.full(nframes, '', dtype=object))
+        tool = 'B5-03859-P{:02d}-CH{}'.format(i // 2 + 1, i % 2)
+        header += [tool, 'Frame', 'State', 'Q0', 'Qx', 'Qy', 'Qz', 'Tx', 'Ty', 'Tz']
+        good = ok[:, i]
+        state = np.where(good, 'OK', 'Tool Missing')
+        vals = [np.where(good, fmt(q[:, i, j], '%.7f'), SENTINEL) for j in range(4)] + \
+               [np.where(good, fmt(xyz[:, i, j], '%.3f'), SENTINEL) for j in range(3)]
+        columns += [np.full(nframes, tool, dtype=object), frame, state] + vals
+        if i in unplugged:
+            columns[-10:] = [np.full(nframes, '', dtype=object)] * 10
+
+    with open(fname, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for row in zip(*columns):
+            f.write('\t'.join(row) + '\n')
+    return names
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic NDI WaveFront recording.')
+    parser.add_argument('fname')
+    parser.add_argument('--channels', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10., help='seconds')
+    parser.add_argument('--fs', type=float, default=200., help='frames per second')
+    parser.add_argument('--dropout', type=float, default=0.01, help='fraction of sensor frames missing')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--unplugged', type=int, nargs='*', default=[],
+                        help='channels (from 0) with no sensor plugged in')
+    args = parser.parse_args(argv)
+    names = write_recording(args.fname, args.channels, args.duration, args.fs, args.dropout, args.seed,
+                            args.unplugged)
+    print(' '.join(names))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of ema, on the recordings in data/ and on synthetic recordings (synth_ndi).
+
+    python -m pytest -q test_ema.py
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import ema, synth_ndi
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+subcolumns = synth_ndi.subcolumns
+
+# the channels of the data/human_test recordings: the head sensors and the biteplate sensors
+human_sensors = ['ch{}'.format(i) for i in range(15)]
+for i, s in ((3, 'REF'), (4, 'OS'), (8, 'RMA'), (9, 'LMA'), (10, 'MS')):
+    human_sensors[i] = s
+
+def two_stage_difference(mydir, bpname, fname, sensors):
+    '''the largest distance (mm) between head_correct_data and the two-stage correction'''
+    cal = ema.biteplate_calibration(mydir, bpname, sensors, subcolumns)
+    df = ema.read_ndi_data(mydir, fname, sensors, subcolumns, cache=False)
+    sensors = [s for s in sensors if df['{}_x'.format(s)].notna().any()]
+    cols = ['{}_{}'.format(s, c) for s in sensors for c in 'xyz']
+    direct = ema.head_correct_data(df.copy(), cal.ideal_head, sensors)
+    head = ema.head_stabilize_data(df.copy(), sensors)
+    m, origin = ema.head_space_calibration(head.attrs['head_template'], cal.ideal_head)
+    two = ema.transform_data(head, m, origin, sensors)
+    diff = (two[cols].to_numpy() - direct[cols].to_numpy()).reshape(len(df), len(sensors), 3)
+    return np.nanmax(np.linalg.norm(diff, axis=2))
+
+def test_head_space_rigid(tmp_path, monkeypatch):
+    '''with a rigid head the two-stage correction is the direct fit'''
+    monkeypatch.setattr(ema, 'cache_dir', None)
+    sensors = synth_ndi.write_recording(str(tmp_path / 'bp.tsv'), duration=2., seed=3)
+    synth_ndi.write_recording(str(tmp_path / 'r.tsv'), duration=5., seed=4)
+    assert two_stage_difference(str(tmp_path), 'bp.tsv', 'r.tsv', sensors) < 1e-3
+
+@pytest.mark.parametrize('fname', ['human_test_with_6dref_000.tsv', 'human_test_without_6dref_001.tsv'])
+def test_head_space_recordings(fname, monkeypatch):
+    '''on real head sensors the two-stage correction is within 0.25 mm of the direct fit'''
+    monkeypatch.setattr(ema, 'cache_dir', None)
+    monkeypatch.setattr(ema.Calibration, 'save', lambda self, fname: None)
+    diff = two_stage_difference(datadir, 'human_test_without_6dref_biteplate_002.tsv', fname,
+                                human_sensors)
+    assert 0.01 < diff < 0.25
+
+def test_mask_bad_states_per_sensor(tmp_path):
+    '''every sensor is masked by its own columns, whichever sensor comes first'''
+    sensors = synth_ndi.write_recording(str(tmp_path / 'r.tsv'), nchannels=4, duration=2.,
+                                        dropout=0.05)
+    df = ema.read_ndi_data(str(tmp_path), 'r.tsv', sensors, subcolumns, cache=False)
+    fname = str(tmp_path / 'r.tsv')
+    usecols, kwargs = ema._read_csv_args(fname, sensors, subcolumns, ['state', 'x', 'y', 'z'], None)
+    raw = pd.read_csv(fname, **kwargs)   # not masked yet
+    raw = raw.drop(columns=['{}_{}'.format(sensors[0], c) for c in 'xyz'])
+    ema.mask_bad_states(raw, ['nosuch'] + sensors[1:], subcolumns, present=sensors[1:])
+    cols = ['{}_{}'.format(s, c) for s in sensors[1:] for c in 'xyz']
+    assert raw[cols].equals(df[cols])
+
+def test_mask_bad_states_missing_column(tmp_path):
+    '''a sensor without the columns the others have is an error, not silently left alone'''
+    sensors = synth_ndi.write_recording(str(tmp_path / 'r.tsv'), nchannels=4, duration=1.)
+    df = ema.read_ndi_data(str(tmp_path), 'r.tsv', sensors, subcolumns, cache=False)
+    df = df.drop(columns=['{}_z'.format(sensors[2])])
+    with pytest.raises(ValueError, match='{}_z'.format(sensors[2])):
+        ema.mask_bad_states(df, sensors, subcolumns)
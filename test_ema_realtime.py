@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the real-time head correction (ema_realtime), on synthetic recordings.
+
+    python -m pytest -q test_ema_realtime.py
+"""
+import numpy as np
+import ema, ema_realtime, synth_ndi
+
+def test_tail_unplugged(tmp_path):
+    '''a channel with no sensor plugged in (empty fields) is read as nan, like read_ndi_data'''
+    names = synth_ndi.write_recording(str(tmp_path / 'r.tsv'), nchannels=10, duration=1.,
+                                      unplugged=(6,))
+    frames = list(ema_realtime.tail_ndi_file(str(tmp_path / 'r.tsv'), names, synth_ndi.subcolumns,
+                                             timeout=0))
+    df = ema.read_ndi_data(str(tmp_path), 'r.tsv', names, synth_ndi.subcolumns, cache=False)
+    want = df.loc[:, ['{}_{}'.format(s, c) for s in names for c in 'xyz']].to_numpy()
+    times = np.array([t for t, xyz in frames])
+    xyz = np.array([xyz for t, xyz in frames])
+    assert np.array_equal(times, df['time'].to_numpy())
+    assert np.isnan(xyz[:, 6]).all()
+    assert np.array_equal(xyz, want.reshape(len(df), len(names), 3), equal_nan=True)
+
+def test_push_result_is_not_overwritten():
+    '''the frames returned by push do not change when more frames are pushed'''
+    idealhd = np.array([[0., 90., 10.], [-70., 20., -80.], [70., 20., -80.]])
+    stream = ema_realtime.HeadCorrectionStream(idealhd, ['REF', 'RMA', 'LMA', 'TT'], capacity=4)
+    xyz = np.concatenate([idealhd, [[0., 0., 0.]]]) + [1., 2., 3.]
+    first = stream.push(0., xyz)
+    batch = stream.push(np.arange(3) + 1., np.repeat(xyz[np.newaxis], 3, axis=0))
+    kept = first.copy(), batch.copy()
+    stream.push(np.arange(4) + 4., np.repeat(xyz[np.newaxis] + 5., 4, axis=0))
+    assert np.array_equal(first, kept[0]) and np.array_equal(batch, kept[1])